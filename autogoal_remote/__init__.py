@@ -12,8 +12,89 @@ This Package enables the following functionalities:
     - export a trained AutoML pipeline to an isolated, minimal Docker Container, and enable operations on this pipeline as a service.
 """
 
-from autogoal_remote.distributed import *
-from autogoal_remote.production import *
+import importlib
 
 from autogoal_remote.distributed import get_algorithms
-from autogoal_remote.cli import typer_app
+
+# names resolved on first use, and the submodule each one comes from, so importing
+# the package doesn't start loading servers, FastAPI or installed contribs. Where
+# both subpackages define a name, `production` wins, as it always did.
+_lazy_names = {
+    "get_all_algorithms": "distributed",
+    "RemoteAlgorithmDTO": "distributed.remote_algorithm",
+    "dumps": "distributed.remote_algorithm",
+    "loads": "distributed.remote_algorithm",
+    "encode": "distributed.remote_algorithm",
+    "decode": "distributed.remote_algorithm",
+    "build_proxy_class": "distributed.proxy",
+    "RemoteAlgorithmBase": "distributed.proxy",
+    "RemoteRef": "distributed.proxy",
+    "materialize": "distributed.proxy",
+    "amaterialize": "distributed.proxy",
+    "RemoteAttrInfo": "distributed.proxy",
+    "AttrCallRequest": "distributed.proxy",
+    "InstantiateRequest": "distributed.proxy",
+    "get_address": "distributed.client",
+    "build_route": "distributed.client",
+    "call_algorithm": "distributed.client",
+    "RemoteSession": "distributed.client",
+    "ConnectionPool": "distributed.client",
+    "Batch": "distributed.client",
+    "get_pool": "distributed.client",
+    "fetch_catalog": "distributed.client",
+    "fetch_catalogs": "distributed.client",
+    "ReplicaGroup": "distributed.replicas",
+    "group_replicas": "distributed.replicas",
+    "Alias": "distributed.config",
+    "ConnectionConfig": "distributed.config",
+    "store_connection": "distributed.config",
+    "clear_connetions": "distributed.config",
+    "get_stored_aliases": "distributed.config",
+    "resolve_alias": "distributed.config",
+    "send_large_message": "distributed.utils",
+    "receive_large_message": "distributed.utils",
+    "has_attr": "distributed.server",
+    "instantiate": "distributed.server",
+    "algorithm_pool": "distributed.server",
+    "Body": "production.client",
+    "ProductionClient": "production.client",
+    "AsyncProductionClient": "production.client",
+    "get_input": "production.client",
+    "get_output": "production.client",
+    "get_inspect": "production.client",
+    "get_ready": "production.client",
+    "post_eval": "production.client",
+    "post_eval_buffers": "production.client",
+    "post_eval_stream": "production.client",
+    "post_eval_records": "production.client",
+    "app": "production.server",
+    "run": "production.server",
+    "serve": "production.server",
+    "load_model": "production.server",
+    "typer_app": "cli",
+}
+
+# submodules, also imported on first use.
+_lazy_modules = ("distributed", "production", "cli")
+
+__all__ = ["get_algorithms", *_lazy_names]
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module(f"{__name__}.{name}")
+
+    if name in _lazy_names:
+        module = importlib.import_module(f"{__name__}.{_lazy_names[name]}")
+        return getattr(module, name)
+
+    # anything else the subpackages used to export, loading their servers
+    if not name.startswith("__"):
+        for module_name in ("distributed", "production"):
+            module = importlib.import_module(f"{__name__}.{module_name}")
+            try:
+                return getattr(module, name)
+            except AttributeError:
+                pass
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,6 +2,7 @@ import collections
 import inspect
 import typer
 from pathlib import Path
+from typing import List
 from rich.console import Console
 import subprocess
 
@@ -94,6 +95,15 @@ def share_contribs(
         "0.0.0.0", help="Interface ip of listening AutoGOAL service"
     ),
     port: int = typer.Argument(8000, help="Port of listening AutoGOAL service"),
+    contrib: List[str] = typer.Option(
+        None, help="Contrib to expose (e.g. sklearn). Can be repeated, all by default"
+    ),
+    algorithm: List[str] = typer.Option(
+        None, help="Algorithm class to expose. Can be repeated, all by default"
+    ),
+    lazy: bool = typer.Option(
+        False, help="Import contribs on the first request instead of on startup"
+    ),
 ):
     """
     Expose algorithms from installed contribs to other AutoGOAL instances over the network.
@@ -104,7 +114,7 @@ def share_contribs(
     except:
         raise Exception("autogoal-remote installation not detected")
 
-    rm_server.distributed.run(ip, port)
+    rm_server.distributed.run(ip, port, contrib or None, algorithm or None, lazy)
 
 
 @app.command("serve")
@@ -112,18 +122,40 @@ def automl_server(
     path: str = typer.Argument(None, help="Autogoal serialized model"),
     ip: str = typer.Argument("0.0.0.0", help="Interface ip to be used by the HTTP API"),
     port: int = typer.Argument(8000, help="Port to be bind by the server"),
+    workers: int = typer.Option(1, help="Number of processes serving the model"),
+    prefork: bool = typer.Option(
+        True,
+        help="Load the model once and share it with the workers, instead of loading it in each worker",
+    ),
+    batch: bool = typer.Option(
+        False, help="Merge concurrent prediction requests into batches"
+    ),
+    cache: bool = typer.Option(
+        False, help="Answer repeated prediction requests from a cache"
+    ),
+    warmup: str = typer.Option(
+        None,
+        help="File with an input (JSON records or pickled) to predict before reporting ready",
+    ),
+    warmup_rounds: int = typer.Option(3, help="Number of warm-up predictions"),
+    artifact_cache: bool = typer.Option(
+        True, help="Load the model from a memory-mappable cache of the export"
+    ),
 ):
     """
     Load and serve a previously trained AutoML instance as a service.
     """
-    from autogoal.ml import AutoML
-    from autogoal_remote.production import run
+    import autogoal_remote.production.server as production_server
     import os
 
+    production_server.warmup_rounds = warmup_rounds
+    production_server.artifact_cache = artifact_cache
+
     default_path = Path(os.getcwd()) / "autogoal-export"
     console.print(f"Loading model from folder: {path or default_path}")
-    model = AutoML.folder_load(Path(path or default_path))
-    run(model, ip, port)
+    production_server.serve(
+        path or default_path, ip, port, workers, prefork, batch, cache, warmup
+    )
 
 
 global typer_app
@@ -1,34 +1,84 @@
+import importlib
+
 from autogoal_remote.distributed.remote_algorithm import *
 from autogoal_remote.distributed.client import *
-from autogoal_remote.distributed.server import *
 from autogoal_remote.distributed.config import *
 from autogoal_remote.distributed.proxy import *
+from autogoal_remote.distributed.replicas import *
 from autogoal_remote.distributed.utils import *
 
 
-def get_algorithms(ip: str = None, port: int = None, alias: str = None):
-    from autogoal_remote.distributed.client import (
-        get_algorithms,
-        build_route,
-        get_address,
-    )
-    import asyncio
-
-    ip, port = get_address(ip, port, alias)
-    uri = f"{build_route(ip, port)}/get-algorithms"
-
-    async def load():
-        raw_algorithms = (await get_algorithms(uri))["algorithms"]
-        return [
-            build_proxy_class(RemoteAlgorithmDTO(**ralg), ip, port)
-            for ralg in raw_algorithms
-        ]
+def __getattr__(name):
+    # the server (FastAPI app, contribs) is only imported when one of its names
+    # is used, e.g. `distributed.run`.
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    server = importlib.import_module(f"{__name__}.server")
+    if name == "server":
+        return server
+    try:
+        return getattr(server, name)
+    except AttributeError:
+        pass
 
+    # other submodules are only attributes of the package once imported
     try:
-        result = asyncio.run(load())
-    except:
-        result = []
-    return result
+        return importlib.import_module(f"{__name__}.{name}")
+    except ModuleNotFoundError as e:
+        if e.name != f"{__name__}.{name}":
+            raise
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_algorithms(ip: str = None, port: int = None, alias: str = None):
+    # an alias that isn't stored falls back to the given address
+    if alias is not None and resolve_alias(alias) is not None:
+        return get_all_algorithms([alias])
+    return get_all_algorithms([(ip, port)])
+
+
+def get_all_algorithms(sources: list = None, replicas: bool = False):
+    """
+    Returns proxy classes for the algorithms exposed by every source, fetched in
+    parallel. A source is an alias, an `(ip, port)` pair or an `(ip, port, alias)`
+    triple, and defaults to every stored alias. Unreachable sources are skipped.
+
+    With `replicas`, an algorithm exposed by several sources gets a single proxy
+    class placing its instances on the least loaded of them (see `ReplicaGroup`).
+    """
+    from autogoal_remote.distributed.client import fetch_catalogs, get_address
+
+    if sources is None:
+        sources = [alias.name for alias in get_stored_aliases()]
+
+    addresses = []
+    for source in sources:
+        if isinstance(source, str):
+            ip, port = get_address(alias=source)
+            addresses.append((ip, port, source))
+        else:
+            ip, port, *alias = source
+            addresses.append((ip, port, alias[0] if alias else f"{ip}-{port}"))
+
+    dtos = []
+    for (ip, port, _), catalog in zip(addresses, fetch_catalogs(addresses)):
+        if isinstance(catalog, BaseException):
+            continue
+
+        try:
+            dtos.extend(
+                (RemoteAlgorithmDTO(**ralg), ip, port) for ralg in catalog["algorithms"]
+            )
+        except:
+            pass
+
+    if not replicas:
+        return [build_proxy_class(dto, ip, port) for dto, ip, port in dtos]
+
+    return [
+        build_replica_class(dto, addresses) for dto, addresses in group_replicas(dtos)
+    ]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+"""
+Admission control for requests on algorithm instances.
+"""
+
+import asyncio
+import collections
+import time
+from contextlib import asynccontextmanager
+
+
+class Overloaded(Exception):
+    """
+    The server can't take the request right now. Clients should try again after
+    `retry_after` seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Lets at most `max_running` requests execute at once, reserving `memory` bytes
+    each from `memory_budget`. Requests that don't fit wait in line, in order of
+    arrival, for at most `queue_timeout` seconds. With `max_queued` requests
+    already waiting, new ones are rejected right away. Rejections carry a hint of
+    how long to wait before trying again, estimated from the recent execution times.
+
+    A request needing more memory than the whole budget still runs, alone.
+    `None` disables the corresponding limit. Must be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_running: int = None,
+        max_queued: int = None,
+        memory_budget: int = None,
+        queue_timeout: float = None,
+        retry_after: float = 1,
+    ):
+        self.configure(max_running, max_queued, memory_budget, queue_timeout)
+        self.retry_after = retry_after
+        self.running = 0
+        self.reserved = 0
+        self.rejected = 0
+        # moving average of execution times, in seconds
+        self.duration = None
+        self._waiters = collections.deque()
+
+    def configure(
+        self,
+        max_running: int = None,
+        max_queued: int = None,
+        memory_budget: int = None,
+        queue_timeout: float = None,
+    ):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.memory_budget = memory_budget
+        self.queue_timeout = queue_timeout
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": len(self._waiters),
+            "reserved": self.reserved,
+            "rejected": self.rejected,
+        }
+
+    def retry_hint(self) -> float:
+        """
+        Seconds until the requests in line are likely to be done.
+        """
+        if self.duration is None:
+            return self.retry_after
+
+        slots = self.max_running or max(self.running, 1)
+        estimate = self.duration * (len(self._waiters) + 1) / slots
+        return round(min(max(estimate, self.retry_after), 60), 3)
+
+    def _fits(self, memory: int) -> bool:
+        if self.max_running is not None and self.running >= self.max_running:
+            return False
+        if self.memory_budget is None or self.running == 0:
+            return True
+        return self.reserved + memory <= self.memory_budget
+
+    def _reject(self, message: str):
+        self.rejected += 1
+        raise Overloaded(message, self.retry_hint())
+
+    @asynccontextmanager
+    async def admit(self, memory: int = 0):
+        """
+        Holds an execution slot and `memory` reserved bytes while inside the block.
+        Raises `Overloaded` if they can't be obtained in time.
+        """
+        if self._waiters or not self._fits(memory):
+            if self.max_queued is not None and len(self._waiters) >= self.max_queued:
+                self._reject(
+                    f"Server overloaded, {len(self._waiters)} requests already waiting"
+                )
+
+            waiter = (asyncio.get_event_loop().create_future(), memory)
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter[0]), self.queue_timeout)
+            except asyncio.TimeoutError:
+                # unless it was admitted right as the wait timed out
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    # it may have been holding back smaller requests behind it
+                    self._wake()
+                    self._reject(
+                        f"Server overloaded, request waited more than {self.queue_timeout}s"
+                    )
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._wake()
+                else:
+                    # admitted meanwhile, hand the slot over to the next one
+                    self._release(memory)
+                raise
+        else:
+            self._acquire(memory)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.duration = (
+                elapsed
+                if self.duration is None
+                else 0.9 * self.duration + 0.1 * elapsed
+            )
+            self._release(memory)
+
+    def _acquire(self, memory: int):
+        self.running += 1
+        self.reserved += memory
+
+    def _release(self, memory: int):
+        self.running -= 1
+        self.reserved -= memory
+        self._wake()
+
+    def _wake(self):
+        # wake up waiters in order, as long as the first one fits
+        while self._waiters and self._fits(self._waiters[0][1]):
+            future, waiting_memory = self._waiters.popleft()
+            self._acquire(waiting_memory)
+            future.set_result(None)
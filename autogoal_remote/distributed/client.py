@@ -1,8 +1,50 @@
+import asyncio
+import concurrent.futures
+import itertools
 import json
-from autogoal_remote.distributed.config import resolve_alias
-from autogoal_remote.distributed.utils import send_large_message, receive_large_message
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+from autogoal_remote import tracing
+from autogoal_remote.distributed import local
+from autogoal_remote.distributed.admission import Overloaded
+from autogoal_remote.distributed.compression import available_codecs
+from autogoal_remote.distributed.config import (
+    get_stored_aliases,
+    load_catalog,
+    resolve_alias,
+    store_catalog,
+)
+from autogoal_remote.distributed.utils import (
+    is_binary,
+    MessageAssembler,
+    receive_large_message,
+    send_large_message,
+    send_message,
+)
 import websockets
 
+# codecs the client can read compressed payloads with, in order of preference.
+# Defaults to every installed codec. Stored aliases may override it per server.
+compression_codecs = available_codecs()
+
+# minimum size (in bytes) of compressed payloads. `None` leaves it to the server.
+compression_threshold = None
+
+# times a request rejected by an overloaded server is sent again. Retries wait at
+# least as long as the server asks, backing off exponentially. Defaults to 5.
+overload_retries = 5
+
+# longest wait (in seconds) before retrying a rejected request. Defaults to 30.
+overload_max_backoff = 30
+
+# move sessions to the Unix socket of servers running on this same host, and
+# exchange large payloads with them through shared memory (see `local`).
+# Defaults to True.
+local_transport = True
+
 
 def get_address(ip: str = None, port: int = None, alias: str = None):
     if alias is not None:
@@ -23,38 +65,525 @@ async def get_algorithms(uri: str):
         return json.loads(response)
 
 
-async def call_algorithm(uri: str, instance_id, attr, args, kwargs):
-    async with websockets.connect(uri) as websocket:
-        request = {
-            "instance_id": instance_id,
-            "attr": attr,
-            "args": args,
-            "kwargs": kwargs,
-        }
-        data = json.dumps(request)
-        await send_large_message(websocket, data, 500)
-        response = await receive_large_message(websocket)
-        response = json.loads(response)
+async def call_algorithm(
+    uri: str,
+    instance_id,
+    attr,
+    args,
+    kwargs,
+    chunk_size: int = 500,
+):
+    with tracing.trace(
+        "remote.call", attr=attr, instance=str(instance_id), server=uri
+    ) as span:
+        async with websockets.connect(uri) as websocket:
+            request = {
+                "instance_id": instance_id,
+                "attr": attr,
+                "args": args,
+                "kwargs": kwargs,
+                "codecs": compression_codecs,
+            }
+            start = _trace_request(span, request)
+            data = json.dumps(request)
+            await send_large_message(websocket, data, chunk_size)
+            sent = time.time_ns()
+            response = await receive_large_message(websocket)
+            response = json.loads(response)
+            _trace_response(span, response, start, sent)
+
+            # simple error handling
+            error = response.get("error")
+            if error is not None:
+                raise Exception(f"Proxy Error (server-side). {error}")
+
+            return response
+
+
+async def has_attr(uri: str, instance_id: str, attr: str):
+    with tracing.trace(
+        "remote.has_attr", attr=attr, instance=str(instance_id), server=uri
+    ) as span:
+        async with websockets.connect(uri) as websocket:
+            request = {"instance_id": instance_id, "attr": attr}
+            start = _trace_request(span, request)
+            await websocket.send(json.dumps(request))
+            sent = time.time_ns()
+            response = json.loads(await websocket.recv())
+            _trace_response(span, response, start, sent)
+            return response
+
+
+async def instantiate(uri: str, algorithm_dto: dict, args: list, kwargs: dict):
+    with tracing.trace(
+        "remote.instantiate", algorithm=algorithm_dto.get("name"), server=uri
+    ) as span:
+        async with websockets.connect(uri) as websocket:
+            request = {"algorithm_dto": algorithm_dto, "args": args, "kwargs": kwargs}
+            start = _trace_request(span, request)
+            await websocket.send(json.dumps(request))
+            sent = time.time_ns()
+            response = json.loads(await websocket.recv())
+            _trace_response(span, response, start, sent)
+            return response
+
+
+def _trace_request(span, request: dict) -> int:
+    # the server reports the timing of every phase of traced requests
+    if span is not None:
+        request["trace"] = span.context
+    return time.time_ns()
+
+
+def _trace_response(span, response: dict, start: int, sent: int):
+    if span is not None:
+        span.add("client.send", start, sent)
+        span.add_server_timings(response.get("timings", {}), sent, time.time_ns())
+
+
+#####################
+#  Session API      #
+#####################
+
+# Every session request is dispatched on a single background event loop. This keeps
+# the pooled websockets alive across calls (a connection is bound to the loop that
+# opened it) and lets synchronous callers, and coroutines running on any other loop
+# (see `run_async`), share them.
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+_pool = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_thread
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(
+                target=_loop.run_forever, name="autogoal-remote-client", daemon=True
+            )
+            _loop_thread.start()
+    return _loop
+
+
+def submit(coro) -> concurrent.futures.Future:
+    """
+    Schedules `coro` in the client loop without waiting for it.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro):
+    """
+    Runs `coro` in the client loop and blocks until its result is available.
+    """
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("Cannot block on a remote call from the client loop itself")
+    return submit(coro).result()
+
+
+async def run_async(coro):
+    """
+    Runs `coro` in the client loop and waits for its result without blocking the
+    loop awaiting it, which may be any loop (the client loop included).
+    """
+    return await asyncio.wrap_future(submit(coro))
+
+
+def _reset_after_fork():
+    # neither the loop thread nor the sockets survive a fork, so the child
+    # starts over with its own loop and pool on first use.
+    global _loop, _loop_thread, _loop_lock, _pool
+    _loop = None
+    _loop_thread = None
+    _loop_lock = threading.Lock()
+    _pool = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class RemoteSession:
+    """
+    Long-lived websocket to the `/session` endpoint of a remote AutoGOAL instance.
+
+    Many requests can be in flight over the same connection. Each one carries a
+    `request_id` that the server echoes back, so responses are matched to their
+    callers regardless of the order in which they arrive. Messages travel as binary
+    frames (see `send_message`), bytes-like values are sent as raw payload.
+
+    Right after connecting, the session advertises `codecs` to the server, which
+    picks the one used to compress payloads above the agreed threshold. Sessions to
+    a server on this same host then move to its Unix socket (see `local_transport`).
+    """
+
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        frame_size: int = None,
+        codecs: List[str] = None,
+        threshold: int = None,
+    ):
+        self.ip = ip
+        self.port = port
+        self.frame_size = frame_size
+        self.codecs = compression_codecs if codecs is None else codecs
+        self.threshold = compression_threshold if threshold is None else threshold
+        # codec and threshold agreed on with the server
+        self.codec = None
+        self.codec_threshold = None
+        # whether the session goes through the Unix socket of the server, and the
+        # payload size from which it uses shared memory then
+        self.local = False
+        self.shared_memory = None
+        # segments received from the server, reported back with the next request
+        self._opened = []
+        self._websocket = None
+        self._reader = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._connect_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._websocket is None or self._websocket.closed:
+                # frames are already bounded by `frame_size`, and per-message deflate
+                # over pickled arrays costs far more time than it saves bandwidth.
+                websocket = await websockets.connect(
+                    f"{build_route(self.ip, self.port)}/session",
+                    max_size=None,
+                    compression=None,
+                )
+                self._attach(websocket, False)
+                response = await self._hello(websocket, self.codecs)
+                if local_transport and "socket" in response:
+                    await self._go_local(response)
+        return self._websocket
+
+    def _attach(self, websocket, is_local: bool):
+        self._websocket = websocket
+        self._reader = asyncio.ensure_future(self._read(websocket, is_local))
+        self.local = is_local
+        self._opened = []
+
+    async def _hello(self, websocket, codecs: List[str], **options) -> dict:
+        self.codec = None
+        self.shared_memory = None
+        try:
+            response = await self._send(
+                websocket,
+                "hello",
+                {"codecs": codecs, "threshold": self.threshold, **options},
+            )
+        except Exception:
+            # servers that predate negotiation just get uncompressed payloads
+            return {}
+
+        self.codec = response["codec"]
+        self.codec_threshold = response["threshold"]
+        self.shared_memory = response.get("shared_memory")
+        return response
+
+    async def _go_local(self, hello: dict):
+        """
+        Moves the session to the Unix socket announced by the server in `hello`, if
+        it is reachable from here and the same server answers on it.
+        """
+        path = hello["socket"]
+        if not (local.available() and os.path.exists(path)):
+            return
+
+        try:
+            websocket = await websockets.unix_connect(
+                path, "ws://localhost/session", max_size=None, compression=None
+            )
+        except OSError:
+            return
+
+        remote, reader = self._websocket, self._reader
+        codec, codec_threshold = self.codec, self.codec_threshold
+
+        # payloads are not worth compressing without a network in between
+        self._attach(websocket, True)
+        response = await self._hello(
+            websocket, [], shared_memory=local.shared_memory_threshold
+        )
+
+        if response.get("server_id") == hello.get("server_id"):
+            closing, closing_reader = remote, reader
+        else:
+            # some other server listens on that path, stay where we were
+            closing, closing_reader = websocket, self._reader
+            self._websocket, self._reader, self.local = remote, reader, False
+            self.codec, self.codec_threshold = codec, codec_threshold
+            self.shared_memory = None
+
+        # wait for its reader, so it doesn't fail requests sent on the other socket
+        await closing.close()
+        await closing_reader
+
+    async def _read(self, websocket, is_local=False):
+        assembler = MessageAssembler(shared=is_local)
+        reason = "closed"
+        try:
+            async for frame in websocket:
+                message = assembler.feed(frame)
+                if message is None:
+                    continue
+
+                self._opened.extend(assembler.opened)
+                assembler.opened.clear()
+
+                request_id, response = message
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            # e.g. a shared memory segment that is gone. The rest of the stream can't
+            # be trusted, so the connection is dropped and the next request reconnects
+            reason = f"dropped ({e})"
+            await websocket.close()
+        finally:
+            # whatever is still waiting will never get an answer on this connection
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(
+                            f"Connection to {self.ip}:{self.port} {reason} while waiting for a response"
+                        )
+                    )
+
+    async def request(self, op: str, timings: dict = None, **payload):
+        """
+        Sends `op` and waits for its response. The seconds spent sending it are
+        added to `timings["send"]`, if given.
+        """
+        websocket = await self._connect()
+        return await self._send(websocket, op, payload, timings)
+
+    async def _send(self, websocket, op: str, payload: dict, timings: dict = None):
+        request_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+
+        # the server keeps the segments it sent until told they were opened
+        if self._opened and self.local:
+            payload = dict(payload, opened=self._opened)
+            self._opened = []
+
+        try:
+            with tracing.timed(timings, "send"):
+                segments = await send_message(
+                    websocket,
+                    request_id,
+                    {"op": op, **payload},
+                    self.frame_size,
+                    self.codec,
+                    self.codec_threshold,
+                    self.shared_memory if self.local else None,
+                )
+        except websockets.ConnectionClosed:
+            self._pending.pop(request_id, None)
+            raise
+
+        try:
+            response = await future
+        finally:
+            local.discard(segments)
 
         # simple error handling
         error = response.get("error")
         if error is not None:
+            if "retry_after" in response:
+                raise Overloaded(
+                    f"Proxy Error (server-side). {error}", response["retry_after"]
+                )
             raise Exception(f"Proxy Error (server-side). {error}")
 
         return response
 
+    async def close(self):
+        if self._websocket is not None:
+            await self._websocket.close()
+            await self._reader
 
-async def has_attr(uri: str, instance_id: str, attr: str):
-    async with websockets.connect(uri) as websocket:
-        await websocket.send(json.dumps({"instance_id": instance_id, "attr": attr}))
-        response = await websocket.recv()
-        return json.loads(response)
 
+class ConnectionPool:
+    """
+    Keeps one `RemoteSession` per (ip, port) for the lifetime of the process.
+    """
 
-async def instantiate(uri: str, algorithm_dto: dict, args: list, kwargs: dict):
-    async with websockets.connect(uri) as websocket:
-        await websocket.send(
-            json.dumps({"algorithm_dto": algorithm_dto, "args": args, "kwargs": kwargs})
+    def __init__(self):
+        self._sessions: Dict[Tuple[str, int], RemoteSession] = {}
+
+    def get(self, ip: str = None, port: int = None) -> RemoteSession:
+        key = (ip or "0.0.0.0", port or 8000)
+        session = self._sessions.get(key)
+        if session is None:
+            session = self._sessions[key] = RemoteSession(
+                *key, **_session_options(*key)
+            )
+        return session
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, {}
+        await asyncio.gather(*(session.close() for session in sessions.values()))
+
+
+def _session_options(ip: str, port: int) -> dict:
+    # stored aliases may override the compression defaults for their server
+    for alias in get_stored_aliases():
+        if alias.ip == ip and alias.port == port:
+            return {
+                "codecs": getattr(alias, "compression", None),
+                "threshold": getattr(alias, "compression_threshold", None),
+            }
+    return {}
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the process-wide connection pool. Must be called from the client loop.
+    """
+    global _pool
+
+    if _pool is None:
+        _pool = ConnectionPool()
+    return _pool
+
+
+async def session_request(ip: str, port: int, op: str, timings=None, **payload):
+    for attempt in itertools.count():
+        try:
+            return await get_pool().get(ip, port).request(op, timings, **payload)
+        except Overloaded as e:
+            if attempt >= overload_retries:
+                raise
+
+            # jitter keeps rejected clients from coming back all at once
+            delay = max(e.retry_after, 0.1 * 2**attempt) * random.uniform(1, 1.5)
+            await asyncio.sleep(min(delay, overload_max_backoff))
+
+
+def request(ip: str, port: int, op: str, **payload):
+    """
+    Sends a single operation over the pooled session to `ip:port` and waits for its response.
+    """
+    return run_sync(session_request(ip, port, op, **payload))
+
+
+async def arequest(ip: str, port: int, op: str, **payload):
+    """
+    Awaitable `request`, usable from any event loop.
+    """
+    return await run_async(session_request(ip, port, op, **payload))
+
+
+async def fetch_catalog(ip: str, port: int, name: str = None) -> dict:
+    """
+    Returns the algorithm catalog exposed at `ip:port`. Catalogs are cached on disk
+    under `name`, and only downloaded again when the server reports a new version.
+    """
+    cached = load_catalog(name) if name is not None else None
+    response = await session_request(
+        ip, port, "get-algorithms", etag=cached and cached.get("etag")
+    )
+    if response.get("unchanged"):
+        return cached
+
+    if name is not None:
+        store_catalog(name, response)
+    return response
+
+
+def fetch_catalogs(sources: List[Tuple[str, int, str]]) -> list:
+    """
+    Fetches the catalogs of every `(ip, port, name)` source in parallel. Sources that
+    can't be reached get their exception instead of a catalog.
+    """
+
+    async def fetch_all():
+        return await asyncio.gather(
+            *(fetch_catalog(*source) for source in sources), return_exceptions=True
         )
-        response = await websocket.recv()
-        return json.loads(response)
+
+    return run_sync(fetch_all())
+
+
+class Batch:
+    """
+    Collects operations to be sent to a remote AutoGOAL instance in a single round trip.
+
+    Every method returns the index of the operation it adds. Passing `Batch.ref(index)`
+    instead of an instance id refers to the instance created (or used) by that
+    operation, e.g. to call `run` on an instance instantiated earlier in the batch.
+    Results come back in order, one dict per operation. A failing operation reports
+    its `error` without stopping the rest of the batch.
+    """
+
+    def __init__(self):
+        self.operations = []
+        self.blobs = {}
+
+    @staticmethod
+    def ref(index: int):
+        return {"ref": index}
+
+    def _add(self, op: str, **payload) -> int:
+        index = len(self.operations)
+        operation = {"op": op}
+        for key, value in payload.items():
+            if is_binary(value):
+                self.blobs[f"{index}.{key}"] = value
+            else:
+                operation[key] = value
+        self.operations.append(operation)
+        return index
+
+    def instantiate(self, algorithm_dto: dict, args: bytes, kwargs: bytes) -> int:
+        return self._add(
+            "instantiate", algorithm_dto=algorithm_dto, args=args, kwargs=kwargs
+        )
+
+    def call(self, instance_id, attr: str, args: bytes, kwargs: bytes, **payload):
+        return self._add(
+            "call",
+            instance_id=instance_id,
+            attr=attr,
+            args=args,
+            kwargs=kwargs,
+            **payload,
+        )
+
+    def has_attr(self, instance_id, attr_name: str) -> int:
+        return self._add("has_attr", instance_id=instance_id, attr_name=attr_name)
+
+    def delete(self, instance_id) -> int:
+        return self._add("delete", raw_id=instance_id)
+
+    async def execute_async(self, ip: str, port: int) -> list:
+        response = await session_request(
+            ip, port, "batch", operations=self.operations, **self.blobs
+        )
+
+        results = response["results"]
+        for name, value in response.items():
+            if name != "results":
+                index, key = name.split(".", 1)
+                results[int(index)][key] = value
+        return results
+
+    def execute(self, ip: str, port: int) -> list:
+        return run_sync(self.execute_async(ip, port))
+
+    async def aexecute(self, ip: str, port: int) -> list:
+        """
+        Awaitable `execute`, usable from any event loop.
+        """
+        return await run_async(self.execute_async(ip, port))
@@ -0,0 +1,67 @@
+"""
+Optional payload compression.
+
+Codecs are only offered when their package is installed: `zstandard` for `"zstd"`
+and `lz4` for `"lz4"`. Peers agree on a codec (see `negotiate`) and only compress
+payloads above a size threshold, since small messages don't pay back the cost.
+"""
+
+from typing import List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+# payloads smaller than this (in bytes) are sent as they are, unless peers agree
+# on a different threshold. Defaults to 64Kb.
+default_threshold = 64 * 1024
+
+
+def available_codecs() -> List[str]:
+    """
+    Returns the installed codecs, in order of preference.
+    """
+    codecs = []
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4_frame is not None:
+        codecs.append("lz4")
+    return codecs
+
+
+def negotiate(offered: List[str], supported: List[str] = None) -> Optional[str]:
+    """
+    Picks the first codec in `offered` that is also `supported`, if any.
+    """
+    supported = available_codecs() if supported is None else supported
+    for codec in offered or []:
+        if codec in supported:
+            return codec
+    return None
+
+
+def compress(data, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == "lz4":
+        return lz4_frame.compress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress(data, codec: str) -> bytearray:
+    """
+    Inverse of `compress`. Returns a writable buffer, so arrays rebuilt on top of it
+    behave like the ones rebuilt from uncompressed payloads.
+    """
+    if codec == "zstd":
+        return bytearray(zstandard.ZstdDecompressor().decompress(data))
+    if codec == "lz4":
+        return lz4_frame.decompress(data, return_bytearray=True)
+    raise ValueError(f"Unknown compression codec: {codec}")
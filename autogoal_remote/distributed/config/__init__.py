@@ -1,6 +1,9 @@
+import json
+import os
+import re
 from inspect import getsourcefile
 from os.path import abspath, dirname, join
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import yaml
 from yamlable import YamlAble, yaml_info
@@ -10,10 +13,14 @@ config_dir = dirname(abspath(getsourcefile(lambda: 0)))
 
 @yaml_info(yaml_tag_ns="autogoal.remote.connectionAlias")
 class Alias(YamlAble):
-    def __init__(self, name, ip, port):
+    def __init__(self, name, ip, port, compression=None, compression_threshold=None):
         self.name = name
         self.ip = ip
         self.port = port
+        # codecs to offer this server, in order of preference, and the minimum
+        # payload size to compress. `None` keeps the client defaults.
+        self.compression = compression
+        self.compression_threshold = compression_threshold
 
 
 @yaml_info(yaml_tag_ns="autogoal.remote.connectionConfig")
@@ -45,9 +52,15 @@ def _save_config(config: ConnectionConfig):
         yaml.dump(config, fd)
 
 
-def store_connection(ip: str, port: int, alias: str):
+def store_connection(
+    ip: str,
+    port: int,
+    alias: str,
+    compression: List[str] = None,
+    compression_threshold: int = None,
+):
     config = _load_config() or ConnectionConfig()
-    calias = Alias(alias, ip, port)
+    calias = Alias(alias, ip, port, compression, compression_threshold)
     config.connections[alias] = calias
     _save_config(config)
 
@@ -66,3 +79,28 @@ def get_stored_aliases():
 def resolve_alias(alias_name: str):
     config = _load_config()
     return config.connections.get(alias_name)
+
+
+def _catalog_path(name: str):
+    return join(config_dir, "catalogs", re.sub(r"[^\w.-]", "_", name) + ".json")
+
+
+def load_catalog(name: str) -> Optional[dict]:
+    """
+    Returns the algorithm catalog last fetched from the source `name`, if any.
+    """
+    try:
+        with open(_catalog_path(name), "r") as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+
+def store_catalog(name: str, catalog: dict):
+    path = _catalog_path(name)
+    os.makedirs(dirname(path), exist_ok=True)
+
+    # write and rename, so concurrent readers never see a partial catalog
+    with open(f"{path}.{os.getpid()}", "w") as fd:
+        json.dump(catalog, fd)
+    os.replace(f"{path}.{os.getpid()}", path)
@@ -0,0 +1,126 @@
+"""
+Same-host transport: a Unix domain socket for messages, shared memory for the
+large payloads they carry.
+
+Besides its TCP port, a server listens on the Unix socket at `socket_path(port)`
+and announces it when sessions say `hello`. Clients that can reach that socket
+(i.e. running on the same host) move their session over to it. Payloads of at
+least `shared_memory_threshold` bytes sent over such sessions are copied once
+into a shared memory segment, which the receiving side uses in place.
+"""
+
+import os
+import socket
+import tempfile
+from multiprocessing import resource_tracker, shared_memory
+from typing import List, Optional
+
+# directory holding the Unix sockets of the servers on this host.
+# Defaults to the system temporary directory.
+socket_dir = tempfile.gettempdir()
+
+# payloads (in bytes) from which same-host sessions send them through shared
+# memory instead of the socket. `None` disables it. Defaults to 1Mb.
+shared_memory_threshold = 1 << 20
+
+
+def available() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+def socket_path(port: int) -> str:
+    return os.path.join(socket_dir, f"autogoal-remote-{port}.sock")
+
+
+def bind(port: int) -> Optional[socket.socket]:
+    """
+    Returns a listening Unix socket for the server on `port`, or `None` if another
+    server (e.g. bound to another address) already listens on it.
+    """
+    path = socket_path(port)
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            return None
+        except OSError:
+            # left behind by a server that is gone
+            os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o600)
+    return sock
+
+
+def unbind(port: int):
+    try:
+        os.unlink(socket_path(port))
+    except FileNotFoundError:
+        pass
+
+
+class Segment(shared_memory.SharedMemory):
+    """
+    A shared memory segment. Values loaded from it (e.g. arrays) use its memory in
+    place, so closing it while they are alive only drops this handle, and the
+    memory is unmapped along with the last of them.
+    """
+
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            self._mmap = None
+            super().close()
+
+
+def share(view: memoryview) -> Segment:
+    """
+    Copies `view` into a new segment, to be handed over with `hand_over`.
+    """
+    segment = Segment(create=True, size=view.nbytes)
+    # sessions remove the segments they exchange themselves (see `discard`), which
+    # the resource tracker of either side would otherwise try again on exit
+    resource_tracker.unregister(segment._name, "shared_memory")
+    segment.buf[: view.nbytes] = view
+    return segment
+
+
+def hand_over(segments: List[Segment]):
+    """
+    Leaves `segments` to the receiving side, which removes them once opened.
+    """
+    for segment in segments:
+        segment.close()
+
+
+def discard(segments: List[Segment]):
+    """
+    Removes `segments`, unless the receiving side already did.
+    """
+    for segment in segments:
+        _unlink(segment)
+        segment.close()
+
+
+def open_shared(name: str, size: int) -> memoryview:
+    """
+    Maps the segment `name` sent by the other side and removes it, so it goes away
+    as soon as the returned view (and everything built on it) is released.
+    """
+    segment = Segment(name=name)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    _unlink(segment)
+    view = segment.buf[:size]
+    segment.close()
+    return view
+
+
+def _unlink(segment: Segment):
+    # `unlink` takes the segment out of the resource tracker, so it is put back first
+    resource_tracker.register(segment._name, "shared_memory")
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        resource_tracker.unregister(segment._name, "shared_memory")
@@ -1,22 +1,29 @@
 import autogoal_remote.distributed.client as client
+from autogoal_remote import tracing
 from autogoal_remote.distributed.remote_algorithm import (
+    REF_TAG,
     AlgorithmBase,
     RemoteAlgorithmDTO,
     decode,
     dumps,
+    dumps_buffers,
     encode,
     loads,
+    loads_buffers,
 )
+from autogoal_remote.distributed.utils import BufferList
+import collections
 import json
+import time
 import uuid
-from typing import Dict
+from typing import Dict, List, Tuple
 
 from pydantic import BaseModel
 from requests.api import delete, post
 
 from autogoal.kb import AlgorithmBase
 import asyncio
-from functools import partial
+from functools import lru_cache, partial
 
 
 def build_proxy_class(dto: RemoteAlgorithmDTO, ip: str = None, port: int = None):
@@ -24,10 +31,16 @@ def build_proxy_class(dto: RemoteAlgorithmDTO, ip: str = None, port: int = None)
     port = port or 8000
     id = f"{ip}:{port}-{dto.name}"
     cls = type(id, (RemoteAlgorithmBase,), {})
-    cls.input_types = lambda: loads(dto.input_types)
-    cls.init_input_types = lambda: loads(dto.init_input_types, use_dill=True)
-    cls.get_inner_signature = lambda: loads(dto.inner_signature, use_dill=True)
-    cls.output_type = lambda: loads(dto.output_type)
+    # type metadata is requested over and over during the search but never
+    # changes, so it is only deserialized the first time.
+    cls.input_types = lru_cache(None)(lambda: loads(dto.input_types))
+    cls.init_input_types = lru_cache(None)(
+        lambda: loads(dto.init_input_types, use_dill=True)
+    )
+    cls.get_inner_signature = lru_cache(None)(
+        lambda: loads(dto.inner_signature, use_dill=True)
+    )
+    cls.output_type = lru_cache(None)(lambda: loads(dto.output_type))
     cls.dto = dto
     cls.contrib = dto.contrib
     cls.ip = ip
@@ -41,53 +54,205 @@ class RemoteAlgorithmBase(AlgorithmBase):
     ip: str = None
     port: int = None
 
+    # servers exposing this same algorithm, new instances are placed on one of them
+    # (see `build_replica_class`). Each instance keeps using the one it was placed on.
+    replicas = None
+
+    # results of `run` stay on the server when set, and a `RemoteRef` to them is
+    # returned instead. Can be set on the class or on single instances. Refs are
+    # resolved when passed to remote algorithms, but local ones get the ref itself,
+    # so results handed to them must go through `materialize` (or `amaterialize`).
+    keep_results = False
+
+    # attribute manifest of the remote instance, as returned by the server. Used to
+    # answer attribute lookups locally. Stays `None` for servers that don't send it.
+    _manifest: dict = None
+
     def __new__(cls: type, *args, **kwargs):
-        uri = f"{client.build_route(cls.ip, cls.port)}/algorithm/instantiate"
-        response = asyncio.run(
-            client.instantiate(uri, cls.dto.dict(), dumps(args), dumps(kwargs))
-        )
+        ip, port = cls._place()
+        with _trace_instantiate(cls, ip, port) as span:
+            with tracing.phase(span, "client.dumps"):
+                payload = _instantiate_request(cls, args, kwargs)
+            response = _traced_request(span, ip, port, "instantiate", payload)
+            return cls._from_response(response, ip, port)
+
+    @classmethod
+    async def acreate(cls, *args, **kwargs):
+        """
+        Awaitable counterpart of `cls(*args, **kwargs)`, usable from any event loop.
+        """
+        ip, port = await cls._aplace()
+        with _trace_instantiate(cls, ip, port) as span:
+            with tracing.phase(span, "client.dumps"):
+                payload = _instantiate_request(cls, args, kwargs)
+            response = await _atraced_request(span, ip, port, "instantiate", payload)
+            return cls._from_response(response, ip, port)
+
+    @classmethod
+    def _place(cls) -> Tuple[str, int]:
+        if cls.replicas is None:
+            return cls.ip, cls.port
+        return cls.replicas.choose()
+
+    @classmethod
+    async def _aplace(cls) -> Tuple[str, int]:
+        if cls.replicas is None:
+            return cls.ip, cls.port
+        return await cls.replicas.achoose()
+
+    @classmethod
+    def _from_response(cls, response: dict, ip: str = None, port: int = None):
         instance = super().__new__(cls)
         instance.id = uuid.UUID(response["id"], version=4)
+        instance._manifest = response.get("manifest")
+        # calls must reach the server holding the instance, whatever the class says
+        instance.ip = ip or cls.ip
+        instance.port = port or cls.port
         return instance
 
+    @classmethod
+    def instantiate_many(cls, arguments: List[Tuple[tuple, dict]]) -> list:
+        """
+        Creates one remote instance per `(args, kwargs)` pair in a single round trip.
+        """
+        batch = _instantiate_batch(cls, arguments)
+        ip, port = cls._place()
+        return _instances_from(cls, batch.execute(ip, port), ip, port)
+
+    @classmethod
+    async def ainstantiate_many(cls, arguments: List[Tuple[tuple, dict]]) -> list:
+        """
+        Awaitable `instantiate_many`, usable from any event loop.
+        """
+        batch = _instantiate_batch(cls, arguments)
+        ip, port = await cls._aplace()
+        return _instances_from(cls, await batch.aexecute(ip, port), ip, port)
+
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
         return self.__del__()
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.adelete()
+
     def __del__(self):
         try:
-            delete(
-                f"http://{self.ip or '0.0.0.0'}:{self.port or 8000}/algorithm/{self.id}",
+            # fire and forget, the pooled session takes care of sending it
+            client.submit(
+                client.session_request(
+                    self.ip, self.port, "delete", raw_id=str(self.id)
+                )
             )
         except:
             pass
 
+    async def adelete(self):
+        """
+        Deletes the remote instance and waits until it is gone.
+        """
+        await client.arequest(self.ip, self.port, "delete", raw_id=str(self.id))
+
     def _proxy_call(self, attr_name, *args, **kwargs):
-        uri = f"{client.build_route(self.ip, self.port)}/algorithm/call"
-        response = asyncio.run(
-            client.call_algorithm(
-                uri, str(self.id), attr_name, dumps(args), dumps(kwargs)
-            )
-        )
-        return loads(response["result"])
+        with _trace_call(self, attr_name) as span:
+            with tracing.phase(span, "client.dumps"):
+                payload = _call_request(self, attr_name, args, kwargs)
+            response = _traced_request(span, self.ip, self.port, "call", payload)
+            with tracing.phase(span, "client.loads"):
+                return _call_result(self, response)
+
+    async def acall(self, attr_name, *args, **kwargs):
+        """
+        Awaitable remote call of `attr_name`, e.g. `await instance.acall("run", X)`.
+        Usable from any event loop, calls from many coroutines run concurrently.
+        """
+        await _afetch_refs(self, [args, kwargs])
+        with _trace_call(self, attr_name) as span:
+            with tracing.phase(span, "client.dumps"):
+                payload = _call_request(self, attr_name, args, kwargs)
+            response = await _atraced_request(span, self.ip, self.port, "call", payload)
+            with tracing.phase(span, "client.loads"):
+                return _call_result(self, response)
+
+    def _proxy_calls(self, calls: List[Tuple[str, tuple, dict]]) -> list:
+        """
+        Runs several `(attr_name, args, kwargs)` calls on the remote instance, in
+        order and in a single round trip, e.g. `fit` followed by `transform`.
+        """
+        batch = _calls_batch(self, calls)
+        return _calls_results(self, batch.execute(self.ip, self.port))
+
+    async def acalls(self, calls: List[Tuple[str, tuple, dict]]) -> list:
+        """
+        Awaitable `_proxy_calls`, usable from any event loop.
+        """
+        await _afetch_refs(self, [(args, kwargs) for _, args, kwargs in calls])
+        batch = _calls_batch(self, calls)
+        return _calls_results(self, await batch.aexecute(self.ip, self.port))
 
     def _has_attr(self, attr_name):
-        uri = f"{client.build_route(self.ip, self.port)}/algorithm/has_attr"
-        response = asyncio.run(client.has_attr(uri, str(self.id), attr_name))
+        # answer from the manifest whenever it is conclusive
+        info = _manifest_attr_info(self, attr_name)
+        if info is not None:
+            return info
+
+        payload = {"instance_id": str(self.id), "attr_name": attr_name}
+        with _trace_call(self, attr_name, "remote.has_attr") as span:
+            response = _traced_request(span, self.ip, self.port, "has_attr", payload)
+        response.pop("timings", None)
+        return RemoteAttrInfo.construct(**response, attr=attr_name)
+
+    async def _ahas_attr(self, attr_name):
+        info = _manifest_attr_info(self, attr_name)
+        if info is not None:
+            return info
+
+        payload = {"instance_id": str(self.id), "attr_name": attr_name}
+        with _trace_call(self, attr_name, "remote.has_attr") as span:
+            response = await _atraced_request(
+                span, self.ip, self.port, "has_attr", payload
+            )
+        response.pop("timings", None)
         return RemoteAttrInfo.construct(**response, attr=attr_name)
 
+    async def agetattr(self, name):
+        """
+        Awaitable attribute access. Methods come back as coroutine functions, e.g.
+        `await (await instance.agetattr("run"))(X)`, see `acall`.
+        """
+        remote_attr_info = await self._ahas_attr(name)
+        if remote_attr_info.exists:
+            if remote_attr_info.is_callable:
+                return partial(self.acall, name)
+
+            entry = (self._manifest or {}).get("attrs", {}).get(name, {})
+            if "value" in entry:
+                return entry["value"]
+
+            return await self.acall("__getattribute__", name)
+
     def __getattribute__(self, name):
         # Calls to proxy_call are not supposed to be proxied.
         # Check for attributes from the local instance
-        if (
-            name == "_proxy_call"
-            or name == "_has_attr"
-            or name == "id"
-            or name == "ip"
-            or name == "port"
-            or name == "__class__"
+        if name in (
+            "_proxy_call",
+            "_proxy_calls",
+            "_has_attr",
+            "_manifest",
+            "keep_results",
+            "acall",
+            "acalls",
+            "adelete",
+            "agetattr",
+            "_ahas_attr",
+            "id",
+            "ip",
+            "port",
+            "__class__",
         ):
             return object.__getattribute__(self, name)
 
@@ -100,6 +265,11 @@ class RemoteAlgorithmBase(AlgorithmBase):
                 #  which will take up the args and kwargs specified by the caller
                 return partial(self._proxy_call, name)
 
+            # immutable class-level values come with the manifest
+            entry = (self._manifest or {}).get("attrs", {}).get(name, {})
+            if "value" in entry:
+                return entry["value"]
+
             # if object is not callable then return the exact attr from the remote object
             return self._proxy_call("__getattribute__", name)
 
@@ -115,6 +285,285 @@ class RemoteAlgorithmBase(AlgorithmBase):
         pass
 
 
+# live handles to the results kept by every server. Arguments only go through the
+# (slower) pickler looking for handles when some may be among them.
+_live_refs = collections.Counter()
+
+
+class RemoteRef:
+    """
+    Handle to a result kept on the server that computed it (see `keep_results`).
+
+    Passed to later calls on the same server, only the handle travels and the server
+    uses the result it kept. Anywhere else (calls on other servers, local algorithms
+    through `materialize`, pickling) it stands for the result, fetched once with
+    `fetch`. The result is dropped when the handle is released (or garbage
+    collected), or when the instance that produced it is deleted.
+    """
+
+    def __init__(self, ip: str, port: int, id: str, owner: str, type: str):
+        self.ip = ip
+        self.port = port
+        self.id = id
+        self.owner = owner
+        self.type = type
+        self._value = None
+        self._fetched = False
+        self._released = False
+        _live_refs[(ip, port)] += 1
+
+    def fetch(self):
+        """
+        Returns the result, bringing it from the server the first time.
+        """
+        if not self._fetched:
+            response = client.request(self.ip, self.port, "fetch_ref", ref_id=self.id)
+            self._value = loads_buffers(response["result"])
+            self._fetched = True
+        return self._value
+
+    async def afetch(self):
+        """
+        Awaitable `fetch`, usable from any event loop.
+        """
+        if not self._fetched:
+            response = await client.arequest(
+                self.ip, self.port, "fetch_ref", ref_id=self.id
+            )
+            self._value = loads_buffers(response["result"])
+            self._fetched = True
+        return self._value
+
+    def release(self):
+        if self._released:
+            return
+
+        self._released = True
+        try:
+            _live_refs[(self.ip, self.port)] -= 1
+            # fire and forget, like deleting an instance
+            client.submit(
+                client.session_request(
+                    self.ip, self.port, "release_ref", ref_id=self.id
+                )
+            )
+        except:
+            pass
+
+    def __del__(self):
+        self.release()
+
+    def __reduce__(self):
+        return _materialized, (self.fetch(),)
+
+    def __repr__(self) -> str:
+        return f"RemoteRef({self.type} at {self.ip}:{self.port})"
+
+
+def _materialized(value):
+    return value
+
+
+def materialize(value):
+    """
+    Returns the result a `RemoteRef` stands for, any other value as it is. To be
+    used before handing results of remote algorithms to local ones.
+    """
+    if isinstance(value, RemoteRef):
+        return value.fetch()
+    return value
+
+
+async def amaterialize(value):
+    """
+    Awaitable `materialize`, usable from any event loop.
+    """
+    if isinstance(value, RemoteRef):
+        return await value.afetch()
+    return value
+
+
+async def _afetch_refs(instance: RemoteAlgorithmBase, values):
+    """
+    Fetches the results of the refs among `values` (looking into lists, tuples,
+    sets and dicts) that are kept on other servers than the one of `instance`, so
+    pickling them (see `RemoteRef.__reduce__`) doesn't block the awaiting loop.
+    """
+    address = (instance.ip, instance.port)
+    if not any(n for key, n in _live_refs.items() if key != address):
+        return
+
+    refs, pending = {}, [values]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, RemoteRef):
+            if (value.ip, value.port) != address and not value._fetched:
+                refs[id(value)] = value
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            pending.extend(value)
+
+    await asyncio.gather(*(ref.afetch() for ref in refs.values()))
+
+
+def _trace_instantiate(cls, ip: str, port: int):
+    return tracing.trace(
+        "remote.instantiate", algorithm=cls.dto.name, server=f"{ip}:{port}"
+    )
+
+
+def _trace_call(instance: RemoteAlgorithmBase, attr_name: str, name="remote.call"):
+    return tracing.trace(
+        name,
+        algorithm=instance.__class__.dto.name,
+        attr=attr_name,
+        instance=str(instance.id),
+        server=f"{instance.ip}:{instance.port}",
+    )
+
+
+def _traced_request(span, ip: str, port: int, op: str, payload: dict) -> dict:
+    """
+    Sends `op` like `client.request`. When traced, the request carries the context
+    of `span`, and the phases measured on both sides are added to it.
+    """
+    if span is None:
+        return client.request(ip, port, op, **payload)
+
+    timings, start = {}, time.time_ns()
+    response = client.request(
+        ip, port, op, timings=timings, trace=span.context, **payload
+    )
+    _add_timings(span, timings, response, start)
+    return response
+
+
+async def _atraced_request(span, ip: str, port: int, op: str, payload: dict) -> dict:
+    if span is None:
+        return await client.arequest(ip, port, op, **payload)
+
+    timings, start = {}, time.time_ns()
+    response = await client.arequest(
+        ip, port, op, timings=timings, trace=span.context, **payload
+    )
+    _add_timings(span, timings, response, start)
+    return response
+
+
+def _add_timings(span: tracing.Span, timings: dict, response: dict, start: int):
+    end = time.time_ns()
+    send = start + int(timings.get("send", 0) * 1e9)
+    span.add("client.send", start, send)
+    # what's left is the server, the network and reassembling the response
+    span.add_server_timings(response.get("timings", {}), send, end)
+
+
+def _instantiate_request(cls, args, kwargs) -> dict:
+    return {
+        "algorithm_dto": cls.dto.dict(),
+        "args": BufferList(dumps_buffers(args)),
+        "kwargs": BufferList(dumps_buffers(kwargs)),
+    }
+
+
+def _instantiate_batch(cls, arguments: List[Tuple[tuple, dict]]) -> client.Batch:
+    batch = client.Batch()
+    for args, kwargs in arguments:
+        batch.instantiate(**_instantiate_request(cls, args, kwargs))
+    return batch
+
+
+def _instances_from(cls, responses: list, ip: str, port: int) -> list:
+    # wrap every instance that was created, so they are released even on errors
+    instances = [cls._from_response(r, ip, port) for r in responses if "error" not in r]
+    for response in responses:
+        if "error" in response:
+            raise Exception(f"Proxy Error (server-side). {response['error']}")
+
+    return instances
+
+
+def _manifest_attr_info(instance: RemoteAlgorithmBase, attr_name: str):
+    manifest = instance._manifest
+    if manifest is None:
+        return None
+
+    entry = manifest["attrs"].get(attr_name)
+    if entry is not None:
+        # e.g. properties, which only the server can tell by running them
+        if entry["callable"] is None:
+            return None
+        return RemoteAttrInfo.construct(
+            attr=attr_name, exists=True, is_callable=entry["callable"]
+        )
+    if manifest["complete"]:
+        return RemoteAttrInfo.construct(attr=attr_name, exists=False, is_callable=False)
+    return None
+
+
+def _call_request(instance: RemoteAlgorithmBase, attr_name: str, args, kwargs):
+    manifest = instance._manifest
+    return {
+        "instance_id": str(instance.id),
+        "attr": attr_name,
+        "manifest_version": manifest and manifest["version"],
+        **_call_arguments(instance, attr_name, args, kwargs),
+    }
+
+
+def _calls_batch(instance: RemoteAlgorithmBase, calls: list) -> client.Batch:
+    batch = client.Batch()
+    for attr_name, args, kwargs in calls:
+        batch.call(**_call_request(instance, attr_name, args, kwargs))
+    return batch
+
+
+def _calls_results(instance: RemoteAlgorithmBase, responses: list) -> list:
+    results = []
+    for response in responses:
+        if "error" in response:
+            raise Exception(f"Proxy Error (server-side). {response['error']}")
+        results.append(_call_result(instance, response))
+    return results
+
+
+def _call_arguments(instance: RemoteAlgorithmBase, attr_name: str, args, kwargs):
+    ip, port = instance.ip, instance.port
+    refs = []
+
+    def persistent_id(obj):
+        if isinstance(obj, RemoteRef) and obj.ip == ip and obj.port == port:
+            refs.append(obj.id)
+            return (REF_TAG, obj.id)
+        return None
+
+    if not _live_refs[(ip, port)]:
+        persistent_id = None
+
+    payload = {
+        "args": BufferList(dumps_buffers(args, persistent_id)),
+        "kwargs": BufferList(dumps_buffers(kwargs, persistent_id)),
+    }
+
+    # only sent when used, servers that predate kept results reject them
+    if refs:
+        payload["refs"] = list(dict.fromkeys(refs))
+    if attr_name == "run" and instance.keep_results:
+        payload["keep"] = True
+    return payload
+
+
+def _call_result(instance: RemoteAlgorithmBase, response: dict):
+    # the server only sends a manifest back when the call changed it
+    if "manifest" in response:
+        instance._manifest = response["manifest"]
+
+    if "ref" in response:
+        return RemoteRef(instance.ip, instance.port, **response["ref"])
+    return loads_buffers(response["result"])
+
+
 class AttrCallRequest(BaseModel):
     instance_id: str
     attr: str
@@ -1,6 +1,8 @@
+import io
 import pickle
 import re
-from typing import Dict
+import struct
+from typing import Callable, Dict, List
 
 import dill
 from pydantic import BaseModel
@@ -11,6 +13,9 @@ from autogoal.utils._dynamic import dynamic_import
 
 contrib_pattern = r"autogoal_(?P<contrib>\w+)\."
 
+# persistent id of values kept on the server, as `(REF_TAG, ref_id)`.
+REF_TAG = "autogoal-remote-ref"
+
 
 def dumps(data: object, use_dill=False) -> str:
     data = dill.dumps(data) if use_dill else pickle.dumps(data)
@@ -30,6 +35,87 @@ def encode(code: str):
     return code.encode("latin1")
 
 
+def dumps_binary(data: object, use_dill=False) -> bytes:
+    return dill.dumps(data) if use_dill else pickle.dumps(data)
+
+
+def loads_binary(data, use_dill=False):
+    return dill.loads(data) if use_dill else pickle.loads(data)
+
+
+def dumps_buffers(data: object, persistent_id: Callable = None) -> List[memoryview]:
+    """
+    Pickles `data` with protocol 5, keeping contiguous buffers (e.g. NumPy arrays)
+    out of band. Returns the pickle stream followed by the raw buffers, which are
+    views over the original memory rather than copies. Objects `persistent_id`
+    returns an id for are pickled as that id (see `pickle.Pickler.persistent_id`).
+    """
+    buffers = []
+
+    def callback(buffer: pickle.PickleBuffer):
+        try:
+            buffers.append(buffer.raw())
+        except BufferError:
+            # non-contiguous buffers are serialized in band
+            return True
+        return False
+
+    if persistent_id is None:
+        stream = pickle.dumps(data, protocol=5, buffer_callback=callback)
+        return [memoryview(stream)] + buffers
+
+    output = io.BytesIO()
+    pickler = pickle.Pickler(output, protocol=5, buffer_callback=callback)
+    pickler.persistent_id = persistent_id
+    pickler.dump(data)
+    return [output.getbuffer()] + buffers
+
+
+def loads_buffers(frames: list, persistent_load: Callable = None):
+    """
+    Inverse of `dumps_buffers`. Arrays are rebuilt on top of the given frames, so
+    they are only writable if the frames are (e.g. `bytearray`). Persistent ids are
+    turned back into objects with `persistent_load`.
+    """
+    if persistent_load is None:
+        return pickle.loads(frames[0], buffers=frames[1:])
+
+    unpickler = pickle.Unpickler(io.BytesIO(frames[0]), buffers=frames[1:])
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+FRAME_COUNT = struct.Struct("!I")
+FRAME_SIZE = struct.Struct("!Q")
+
+
+def pack_frames(frames: list) -> list:
+    """
+    Prepends a header with the number and sizes of `frames`, so they can be sent
+    back to back in a single body. Returns the header followed by the frames.
+    """
+    views = [memoryview(f).cast("B") for f in frames]
+    header = FRAME_COUNT.pack(len(views)) + b"".join(
+        FRAME_SIZE.pack(v.nbytes) for v in views
+    )
+    return [header] + views
+
+
+def unpack_frames(data) -> List[memoryview]:
+    """
+    Splits a body built from `pack_frames` into views over `data`, without copying.
+    """
+    data = memoryview(data)
+    (count,) = FRAME_COUNT.unpack_from(data)
+    offset = FRAME_COUNT.size + count * FRAME_SIZE.size
+    frames = []
+    for i in range(count):
+        (size,) = FRAME_SIZE.unpack_from(data, FRAME_COUNT.size + i * FRAME_SIZE.size)
+        frames.append(data[offset : offset + size])
+        offset += size
+    return frames
+
+
 class RemoteAlgorithmDTO(BaseModel):
     name: str
     module: str
@@ -44,7 +130,9 @@ class RemoteAlgorithmDTO(BaseModel):
     def from_local_class(algorithm_cls):
         name = algorithm_cls.__name__
         module = algorithm_cls.__module__
-        contrib = re.search(contrib_pattern, module).group("contrib")
+        # classes outside of a contrib (e.g. stand-ins) are named after their package
+        match = re.search(contrib_pattern, module)
+        contrib = match.group("contrib") if match else module.split(".")[0]
         input_args = dumps(algorithm_cls.input_args())
         init_input_types = dumps(algorithm_cls.init_input_types(), use_dill=True)
         inner_signature = dumps(algorithm_cls.get_inner_signature(), use_dill=True)
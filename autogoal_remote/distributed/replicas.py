@@ -0,0 +1,195 @@
+"""
+Replica groups: several servers exposing the same algorithm, used as a pool of
+capacity by a single proxy class.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import autogoal_remote.distributed.client as client
+from autogoal_remote.distributed.proxy import build_proxy_class
+from autogoal_remote.distributed.remote_algorithm import RemoteAlgorithmDTO
+
+# how new instances are placed among replicas. "load" picks the replica with the
+# fewest requests in flight per unit of capacity, then the one hosting the fewest
+# instances, "latency" the one answering its probes the fastest. Remaining ties
+# go to the fastest replica.
+# Defaults to "load".
+replica_policy = "load"
+
+# seconds between two probes of the same replica. Defaults to 5.
+replica_probe_interval = 5
+
+# seconds a replica has to answer a probe before it is considered down.
+# Defaults to 2.
+replica_probe_timeout = 2
+
+# seconds an unreachable replica is left alone before probing it again.
+# Defaults to 30.
+replica_retry_interval = 30
+
+
+class Replica:
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.healthy = True
+        # last reported load, and instances placed here since it was reported
+        self.load = None
+        self.placed = 0
+        # moving average of the probe round trip, in seconds
+        self.latency = None
+        self.probed = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.ip, self.port
+
+    def due(self, now: float) -> bool:
+        if self.probed is None:
+            return True
+        interval = replica_probe_interval if self.healthy else replica_retry_interval
+        return now - self.probed >= interval
+
+    def score(self) -> tuple:
+        latency = self.latency if self.latency is not None else float("inf")
+        if replica_policy == "latency":
+            return (latency,)
+
+        load = self.load or {}
+        capacity = max(load.get("capacity", 1), 1)
+        instances = load.get("instances", 0) + self.placed
+        return (load.get("in_flight", 0) / capacity, instances / capacity, latency)
+
+    async def probe(self):
+        start = time.perf_counter()
+        try:
+            load = await asyncio.wait_for(
+                client.session_request(self.ip, self.port, "load"),
+                replica_probe_timeout,
+            )
+        except Exception:
+            self.healthy = False
+        else:
+            elapsed = time.perf_counter() - start
+            self.latency = (
+                elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            )
+            self.load = load
+            self.placed = 0
+            self.healthy = True
+        self.probed = time.monotonic()
+
+
+class ReplicaGroup:
+    """
+    Servers exposing the same algorithms. Replicas are probed for their load (see
+    the `load` operation) every `replica_probe_interval` seconds, new instances go
+    to the best one according to `replica_policy`, and unreachable replicas are
+    skipped until they answer again.
+    """
+
+    def __init__(self, replicas: List[Tuple[str, int]]):
+        self.replicas = [Replica(ip, port) for ip, port in replicas]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def choose(self) -> Tuple[str, int]:
+        """
+        Returns the address new instances should be placed on.
+        """
+        self.refresh()
+        return self._pick()
+
+    async def achoose(self) -> Tuple[str, int]:
+        """
+        Awaitable `choose`, usable from any event loop.
+        """
+        await self.arefresh()
+        return self._pick()
+
+    def _pick(self) -> Tuple[str, int]:
+        with self._lock:
+            healthy = [r for r in self.replicas if r.healthy]
+            if not healthy:
+                raise Exception(
+                    f"No replica is reachable among {', '.join(f'{r.ip}:{r.port}' for r in self.replicas)}"
+                )
+
+            replica = min(healthy, key=Replica.score)
+            # until the next probe, spread a burst of instances across replicas
+            replica.placed += 1
+            return replica.address
+
+    def refresh(self, force=False):
+        """
+        Probes every replica whose last probe is older than its interval.
+        """
+        due = self._due(force)
+        if due:
+            client.run_sync(self._probe(due))
+
+    async def arefresh(self, force=False):
+        due = self._due(force)
+        if due:
+            await client.run_async(self._probe(due))
+
+    def _due(self, force: bool) -> List[Replica]:
+        now = time.monotonic()
+        return [r for r in self.replicas if force or r.due(now)]
+
+    @staticmethod
+    async def _probe(replicas: List[Replica]):
+        await asyncio.gather(*(r.probe() for r in replicas))
+
+
+# replica groups are shared among every algorithm exposed by the same servers
+_groups: Dict[tuple, ReplicaGroup] = {}
+
+
+def get_replica_group(replicas: List[Tuple[str, int]]) -> ReplicaGroup:
+    key = tuple(sorted(replicas))
+    group = _groups.get(key)
+    if group is None:
+        group = _groups[key] = ReplicaGroup(list(key))
+    return group
+
+
+def replica_key(dto: RemoteAlgorithmDTO) -> tuple:
+    """
+    Algorithms with the same key are interchangeable, wherever they are exposed.
+    """
+    return (dto.contrib, dto.name, dto.input_args, dto.input_types, dto.output_type)
+
+
+def build_replica_class(dto: RemoteAlgorithmDTO, replicas: List[Tuple[str, int]]):
+    """
+    Proxy class for an algorithm exposed by every server in `replicas`. Each new
+    instance is placed on one of them and stays there for its whole life.
+    """
+    if len(replicas) == 1:
+        return build_proxy_class(dto, *replicas[0])
+
+    cls = build_proxy_class(dto, *replicas[0])
+    cls.__name__ = cls.__qualname__ = f"replicas-{dto.name}"
+    cls.replicas = get_replica_group(replicas)
+    return cls
+
+
+def group_replicas(
+    dtos: List[Tuple[RemoteAlgorithmDTO, str, int]]
+) -> List[Tuple[RemoteAlgorithmDTO, List[Tuple[str, int]]]]:
+    """
+    Merges `(dto, ip, port)` entries describing the same algorithm into a single
+    `(dto, replicas)` entry, in order of first appearance.
+    """
+    groups = {}
+    for dto, ip, port in dtos:
+        _, replicas = groups.setdefault(replica_key(dto), (dto, []))
+        if (ip, port) not in replicas:
+            replicas.append((ip, port))
+    return list(groups.values())
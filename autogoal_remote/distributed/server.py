@@ -1,5 +1,18 @@
+import asyncio
+import copy
+import hashlib
+import importlib
+import inspect
+import os
+import shutil
+import tempfile
+import threading
 import uuid
+import weakref
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from typing import Any
 import uvicorn
 from autogoal_remote.distributed.proxy import (
@@ -8,40 +21,248 @@ from autogoal_remote.distributed.proxy import (
     RemoteAlgorithmDTO,
     decode,
     dumps,
+    dumps_buffers,
     encode,
     loads,
+    loads_buffers,
 )
 
-from fastapi import FastAPI, Request, WebSocket
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.exceptions import HTTPException
 
-from autogoal_contrib import find_classes
 from autogoal.utils import Gb, Hour, Kb, Mb, Min, RestrictedWorkerWithState, Sec
 from autogoal.utils._dynamic import dynamic_call
 
-from autogoal_remote.distributed.utils import receive_large_message, send_large_message
+from autogoal_remote import metrics, tracing
+from autogoal_remote.distributed.admission import AdmissionController, Overloaded
+from autogoal_remote.distributed import local
+from autogoal_remote.distributed.compression import available_codecs, negotiate
+from autogoal_remote.distributed.remote_algorithm import REF_TAG, dumps_binary
+from autogoal_remote.distributed.store import InstanceStore, ObjectStore
+from autogoal_remote.distributed.workers import Worker, WorkerPool
+from autogoal_remote.distributed.utils import (
+    BufferList,
+    is_binary,
+    MessageAssembler,
+    receive_large_message,
+    send_large_message,
+    send_message,
+)
 import pprint
 import time
 
 app = FastAPI()
+metrics.install(app, "distributed")
+
+# references to every exposed algorithm, found on first use (see `exposed_contribs`).
+stored_data = None
+
+# contribs whose algorithms are exposed, e.g. `["sklearn", "nltk"]`. Only these
+# are imported. `None` exposes every installed contrib.
+# Defaults to None.
+exposed_contribs = None
+
+# names of the algorithm classes to expose, among those found in the exposed
+# contribs. `None` exposes all of them.
+# Defaults to None.
+exposed_classes = None
+
+# look for algorithms on the first request for the catalog instead of on
+# startup, so the server starts listening right away.
+# Defaults to False.
+lazy_catalog = False
+
+# pool of algorithm instances. Instances that are not properly deleted are
+# spilled to disk once they exceed `instance_memory_budget` or sit idle for
+# `instance_idle_ttl`, and loaded back when used again.
+# In "process" mode instances live in worker processes, each one filling its
+# own copy of this pool, and it stays empty in the server process.
+algorithm_pool = InstanceStore()
+
+# results kept on the server for clients to pass to later calls (see `RemoteRef`),
+# each one owned by the instance that produced it. Like `algorithm_pool`, in
+# "process" mode every worker process keeps its own.
+object_store = ObjectStore()
+
+# estimated memory (in bytes) algorithm instances may take before the least
+# recently used ones are spilled to disk. In "process" mode it is split evenly
+# among workers. `None` keeps every instance in memory.
+# Defaults to 8Gb.
+instance_memory_budget = 8 * Gb
+
+# seconds an instance can go unused before it is spilled to disk. `None` keeps
+# idle instances in memory.
+# Defaults to 1 Hour.
+instance_idle_ttl = 1 * Hour
+
+# directory spilled instances are written to. `None` uses a temporary directory
+# that is removed when the server stops.
+# Defaults to None.
+instance_spill_dir = None
+
+# where algorithm instances live and run. "process" hosts them in a pool of
+# long-lived worker processes, "thread" keeps them in this process and runs
+# calls in a thread pool (`run` calls still go through a RestrictedWorker).
+# Defaults to "process".
+execution_mode = "process"
+
+# number of worker processes hosting algorithm instances in "process" mode.
+# Defaults to the number of CPUs.
+worker_count = os.cpu_count()
+
+# number of requests on instances that can be executing at the same time.
+# In "process" mode requests beyond `worker_count` just wait for their worker.
+# Defaults to 32.
+execution_threads = 32
+
+# the pool of worker processes and the thread pool, started on the first request.
+_worker_pool = None
+_executor = None
+
+# one lock per instance, so calls on an instance never overlap. Locks only live
+# while in use, so requests for unknown or deleted instances don't pile them up.
+_instance_locks = weakref.WeakValueDictionary()
+
+# number of requests on instances being served right now, reported by `load`.
+_in_flight = 0
+
+# instance owning every kept result, and results kept by every instance.
+_ref_owners = {}
+_instance_refs = {}
+
+# instances every kept result was copied into other workers for (see `_import_refs`).
+_ref_copies = {}
+
+# attribute manifest of every instance, with the attribute names it was built for.
+_manifests = {}
 
-# get references for every algorithm in contribs
-stored_data = find_classes()
+# directory instances are spilled to, set on startup.
+_spill_dir = None
 
-# simple set for pooling algorithm instances. If instances
-# are not properly deleted can (and will) fill the memory
-algorithm_pool = {}
+# catalog of exposed algorithms, built once on startup (or on first use).
+_catalog = None
+_catalog_lock = threading.Lock()
 
 # sets the RAM usage restriction for remote calls. This will only affect
-# remote attribute calls and is ignored during the instance creation.
+# remote `run` calls and is ignored during the instance creation. A worker
+# breaching it is recycled, losing the instances it hosts.
 # Defaults to 4Gb.
 remote_call_memory_limit = 4 * Gb
 
 # sets the remote call timeout. This will only affect
-# remote attribute calls and is ignored during the instance creation.
+# remote `run` calls and is ignored during the instance creation. A worker
+# breaching it is recycled, losing the instances it hosts.
 # Defaults to 20 Sec.
 remote_call_timeout = 20 * Sec
 
+# number of `instantiate` and `call` requests executing at the same time, the
+# rest wait in line. `None` uses `worker_count` in "process" mode and
+# `execution_threads` in "thread" mode.
+# Defaults to None.
+max_running_requests = None
+
+# number of requests that may wait in line. Further requests are rejected right
+# away, telling the client when to try again. `None` lets the line grow unbounded.
+# Defaults to 256.
+max_queued_requests = 256
+
+# seconds a request may wait in line before it is rejected. `None` waits forever.
+# Defaults to 10 Sec.
+max_queue_wait = 10 * Sec
+
+# memory (in bytes) that running `run` calls may reserve together, each one
+# reserving `remote_call_memory_limit`. `None` uses the physical memory of the
+# machine, when known.
+# Defaults to None.
+reserved_memory_limit = None
+
+# minimum seconds clients are told to wait before retrying a rejected request.
+# Defaults to 1 Sec.
+retry_after = 1 * Sec
+
+# limits the requests above, configured on startup.
+_admission = AdmissionController()
+
+# class-level values of these types are shipped inside attribute manifests, so
+# clients can read them without a round trip.
+manifest_value_types = (bool, int, float, str, type(None))
+
+# codecs this server is willing to compress payloads with, in order of preference.
+# Clients pick among them when connecting. Defaults to every installed codec.
+compression_codecs = available_codecs()
+
+# payloads smaller than this are never compressed, unless the client asks for a
+# different threshold. Defaults to 64Kb.
+compression_threshold = 64 * Kb
+
+# size (in bytes) of the data frames used to stream payloads over `/session`.
+# Defaults to 1Mb.
+session_frame_size = 1 * Mb
+
+# size (in characters) of the chunks `/algorithm/call` sends its responses in.
+# Defaults to 500.
+call_chunk_size = 500
+
+# also listen on a Unix socket (see `local.socket_path`), so sessions from this
+# same host skip TCP and exchange large payloads through shared memory.
+# Defaults to True.
+local_transport = True
+
+# tells sessions reaching this server through both sockets apart from sessions
+# reaching another server that happens to use the same socket path.
+server_id = uuid.uuid4().hex
+
+# Unix socket this server listens on, if any. Set by `run`.
+_local_socket = None
+
+
+@app.on_event("startup")
+def startup():
+    global _spill_dir
+
+    budget = instance_memory_budget
+    if budget is not None and execution_mode == "process":
+        budget = budget // worker_count
+
+    _spill_dir = instance_spill_dir or tempfile.mkdtemp(prefix="autogoal-remote-")
+    configure = partial(algorithm_pool.configure, budget, instance_idle_ttl, _spill_dir)
+    if execution_mode == "process":
+        # first thing, as no thread may be running yet (see `workers`)
+        _get_worker_pool(configure)
+    else:
+        configure()
+
+    if not lazy_catalog:
+        _get_catalog()
+
+    running = max_running_requests
+    if running is None:
+        running = worker_count if execution_mode == "process" else execution_threads
+    _admission.configure(
+        running,
+        max_queued_requests,
+        reserved_memory_limit or _physical_memory(),
+        max_queue_wait,
+    )
+    _admission.retry_after = retry_after
+
+
+def _physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+@app.on_event("shutdown")
+def shutdown():
+    if _worker_pool is not None:
+        _worker_pool.close()
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    if _spill_dir is not None and instance_spill_dir is None:
+        shutil.rmtree(_spill_dir, ignore_errors=True)
+
 
 #####################
 #     HTTP API      #
@@ -53,11 +274,20 @@ async def root():
     return {"message": "Service Running"}
 
 
+@app.get("/load")
+async def get_load():
+    """
+    Returns how busy the server is
+    """
+    return _get_load()
+
+
 @app.get("/algorithms")
 async def get_exposed_algorithms(request: Request):
     """
     Returns exposed algorithms
     """
+    stored_data = _get_stored_data()
     remote_algorithms = [
         RemoteAlgorithmDTO.from_algorithm_class(a) for a in stored_data
     ]
@@ -125,9 +355,10 @@ async def instantiate(request: InstantiateRequest):
 @app.delete("/algorithm/{raw_id}")
 async def delete_algorithm(raw_id):
     id = uuid.UUID(raw_id, version=4)
+    _manifests.pop(id, None)
 
     try:
-        algorithm_pool.pop(id)
+        del algorithm_pool[id]
     except KeyError:
         # do nothing, key is already out of the pool. Dont ask that many questions...
         pass
@@ -146,14 +377,7 @@ async def get_exposed_algorithms(websocket: WebSocket):
     Returns exposed algorithms
     """
     await websocket.accept()
-    remote_algorithms = [
-        RemoteAlgorithmDTO.from_local_class(a).dict() for a in stored_data
-    ]
-    data = {
-        "message": f"Exposing {str(len(stored_data))} algorithms: {', '.join([a.__name__ for a in stored_data])}",
-        "algorithms": remote_algorithms,
-    }
-    await websocket.send_json(data)
+    await websocket.send_json(await _dispatch("get-algorithms", {}))
 
 
 fid = id
@@ -164,98 +388,914 @@ async def call(websocket: WebSocket):
     await websocket.accept()
     data = await receive_large_message(websocket)
     request = json.loads(data)
-    id = uuid.UUID(request["instance_id"], version=4)
-    inst = algorithm_pool.get(id)
-    if inst == None:
-        await websocket.send_json(
-            {"error": f"Algorithm instance with id={id} not found"}
-        )
-        return
-
-    attr = getattr(inst, request["attr"])
-    is_callable = hasattr(attr, "__call__")
-    run_as_restricted = is_callable and request["attr"] == "run"
-
-    args = loads(request["args"])
-    kwargs = loads(request["kwargs"])
-
-    func = (
-        RestrictedWorkerWithState(
-            dynamic_call, remote_call_timeout, remote_call_memory_limit
-        )
-        if run_as_restricted
-        else dynamic_call
-    )
 
     try:
-        result = attr
-        if is_callable:
-            result = func(
-                inst,
-                request["attr"],
-                *args,
-                **kwargs,
-            )
-
-        if run_as_restricted:
-            result, ninstance = result
-            if ninstance is not None:
-                algorithm_pool[id] = ninstance
-
-        result_data = json.dumps({"result": dumps(result)})
+        response = await _dispatch(
+            "call",
+            {
+                "instance_id": request["instance_id"],
+                "attr": request["attr"],
+                "args": BufferList([encode(request["args"])]),
+                "kwargs": BufferList([encode(request["kwargs"])]),
+                "inband": True,
+                **_trace_of(request),
+            },
+        )
+        if "error" in response:
+            result_data = json.dumps({"error": response["error"]})
+        else:
+            result = {"result": decode(response["result"][0])}
+            if "timings" in response:
+                result["timings"] = response["timings"]
+            result_data = json.dumps(result)
+    except Overloaded as e:
+        result_data = json.dumps({"error": str(e), "retry_after": e.retry_after})
     except Exception as e:
         result_data = json.dumps({"error": str(e)})
 
-    await send_large_message(websocket, result_data, 500)
+    # clients may advertise the codecs they can read the response with
+    codec = negotiate(request.get("codecs"), compression_codecs)
+    if len(result_data) < compression_threshold:
+        codec = None
+
+    await send_large_message(websocket, result_data, call_chunk_size, codec)
 
 
 @app.websocket("/algorithm/has_attr")
 async def has_attr(websocket: WebSocket):
     await websocket.accept()
     request = await websocket.receive_json()
-    id = uuid.UUID(request["instance_id"], version=4)
-    inst = algorithm_pool.get(id)
-    if inst == None:
-        await websocket.send_json(
-            {"error": f"Algorithm instance with id={id} not found"}
-        )
-        return
 
     try:
-        attr = getattr(inst, request["attr"])
-        result = True
-    except:
-        result = False
+        response = await _dispatch(
+            "has_attr",
+            {
+                "instance_id": request["instance_id"],
+                "attr_name": request["attr"],
+                **_trace_of(request),
+            },
+        )
+    except Overloaded as e:
+        response = {"error": str(e), "retry_after": e.retry_after}
+    except Exception as e:
+        response = {"error": str(e)}
 
-    await websocket.send_json(
-        {"exists": result, "is_callable": result and hasattr(attr, "__call__")}
-    )
+    await websocket.send_json(response)
 
 
 @app.websocket("/algorithm/instantiate")
 async def instantiate(websocket: WebSocket):
     await websocket.accept()
     request = await websocket.receive_json()
-    dto = RemoteAlgorithmDTO.parse_obj(request["algorithm_dto"])
-    cls = dto.get_local_class()
-    new_id = uuid.uuid4()
-    algorithm_pool[new_id] = cls(*loads(request["args"]), **loads(request["kwargs"]))
-    await websocket.send_json({"message": "success", "id": str(new_id)})
+
+    try:
+        response = await _dispatch(
+            "instantiate",
+            {
+                "algorithm_dto": request["algorithm_dto"],
+                "args": BufferList([encode(request["args"])]),
+                "kwargs": BufferList([encode(request["kwargs"])]),
+                **_trace_of(request),
+            },
+        )
+    except Overloaded as e:
+        response = {"error": str(e), "retry_after": e.retry_after}
+    except Exception as e:
+        response = {"error": str(e)}
+
+    await websocket.send_json(response)
+
+
+def _trace_of(request: dict) -> dict:
+    # legacy requests only carry a trace context when the client traces them
+    return {"trace": request["trace"]} if "trace" in request else {}
 
 
 @app.websocket("/algorithm/delete/{raw_id}")
 async def delete_algorithm(websocket: WebSocket, raw_id):
     await websocket.accept()
+    await websocket.send_json(await _dispatch("delete", {"raw_id": raw_id}))
+
+
+@app.websocket("/session")
+async def session(websocket: WebSocket):
+    """
+    Long-lived connection carrying many requests. Every request names its
+    operation in `op` and is answered with the same request id, so clients
+    can keep several requests in flight at once.
+    """
+    await websocket.accept()
+    # uvicorn reports no server address for connections through the Unix socket
+    is_local = _local_socket is not None and websocket.scope.get("server") is None
+    assembler = MessageAssembler(shared=is_local)
+    tasks = set()
+
+    # segments sent to the client and not reported as opened yet. Whatever is left
+    # when the client goes away is removed.
+    handed_over = {}
+
+    # settings agreed on with the client through the `hello` operation
+    options = {"codec": None, "threshold": None, "shared_memory": None}
+
+    def hello(codecs: list = None, threshold: int = None, shared_memory: int = None):
+        options["codec"] = negotiate(codecs, compression_codecs)
+        options["threshold"] = compression_threshold if threshold is None else threshold
+        if is_local:
+            options["shared_memory"] = shared_memory
+
+        response = dict(options, server_id=server_id)
+        if _local_socket is not None:
+            response["socket"] = _local_socket
+        return response
+
+    async def serve(request_id, request):
+        op = request.pop("op", None)
+        endpoint = f"/session:{op}"
+        metrics.observe(
+            "autogoal_remote_payload_bytes",
+            _payload_size(request),
+            metrics.size_buckets,
+            direction="in",
+            endpoint=endpoint,
+        )
+
+        start = time.perf_counter()
+        try:
+            response = (
+                hello(**request) if op == "hello" else await _dispatch(op, request)
+            )
+        except Overloaded as e:
+            response = {"error": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            response = {"error": str(e)}
+
+        if "timings" in response:
+            response["timings"]["server"] = time.perf_counter() - start
+
+        metrics.inc(
+            "autogoal_remote_requests_total",
+            server="distributed",
+            endpoint=endpoint,
+            status="error" if "error" in response else "ok",
+        )
+        metrics.observe(
+            "autogoal_remote_request_seconds",
+            time.perf_counter() - start,
+            server="distributed",
+            endpoint=endpoint,
+        )
+        metrics.observe(
+            "autogoal_remote_payload_bytes",
+            _payload_size(response),
+            metrics.size_buckets,
+            direction="out",
+            endpoint=endpoint,
+        )
+
+        try:
+            segments = await send_message(
+                websocket,
+                request_id,
+                response,
+                session_frame_size,
+                options["codec"],
+                options["threshold"],
+                options["shared_memory"],
+            )
+        except Exception:
+            # the client went away, nobody is waiting for this response anymore
+            pass
+        else:
+            local.hand_over(segments)
+            handed_over.update((segment.name, segment) for segment in segments)
+
+    try:
+        while True:
+            message = assembler.feed(await websocket.receive_bytes())
+            # the segments sent by the client are removed by the client itself
+            assembler.opened.clear()
+            if message is None:
+                continue
+
+            for name in message[1].pop("opened", ()):
+                handed_over.pop(name, None)
+
+            task = asyncio.ensure_future(serve(*message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        local.discard(list(handed_over.values()))
+
+
+#####################
+#    Operations     #
+#####################
+
+
+# calls that only read the instance, so its size isn't estimated again after them.
+_reads = {"__getattribute__", "__repr__", "__str__"}
+
+
+@contextmanager
+def _use_instance(raw_id: str, changed: bool = True):
+    """
+    Yields the id and instance for `raw_id`, which stays in memory meanwhile.
+    """
+    id = uuid.UUID(raw_id, version=4)
+    if id not in algorithm_pool:
+        raise Exception(f"Algorithm instance with id={id} not found")
+
+    with algorithm_pool.use(id, changed) as inst:
+        yield id, inst
+
+
+def _manifest(inst, id=None):
+    """
+    Describes every attribute reachable from `inst`: whether it is callable and, for
+    immutable class-level values, the value itself. The manifest is `complete` unless
+    the class resolves attributes dynamically through `__getattr__`.
+
+    Attributes are looked up statically, so no property or other descriptor runs.
+    Whether those are callable is left unknown (`None`), for clients to ask. Given
+    the instance `id`, the manifest is reused until its attribute names change.
+    """
+    instance_dict = getattr(inst, "__dict__", {})
+    if id is not None:
+        key = (type(inst), tuple(instance_dict))
+        cached = _manifests.get(id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    names = set(instance_dict)
+    for klass in type(inst).__mro__:
+        names.update(vars(klass))
+
+    attrs = {}
+    for name in names:
+        try:
+            attr = inspect.getattr_static(inst, name)
+        except AttributeError:
+            continue
+        attrs[name] = _manifest_entry(inst, name, attr, instance_dict)
+
+    manifest = {
+        "attrs": attrs,
+        "complete": inspect.getattr_static(type(inst), "__getattr__", None) is None,
+    }
+    manifest["version"] = hashlib.blake2b(
+        json.dumps(manifest, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+
+    if id is not None:
+        _manifests[id] = (key, manifest)
+    return manifest
+
+
+def _manifest_entry(inst, name: str, attr, instance_dict: dict) -> dict:
+    if name in instance_dict and attr is instance_dict[name]:
+        return {"callable": callable(attr)}
+
+    if isinstance(attr, (staticmethod, classmethod)):
+        return {"callable": True}
+
+    getter = getattr(type(attr), "__get__", None)
+    if getter is not None:
+        # methods stay callable once bound, other descriptors (e.g. properties)
+        # would have to run to tell
+        is_data = hasattr(type(attr), "__set__") or hasattr(type(attr), "__delete__")
+        return {"callable": True if callable(attr) and not is_data else None}
+
+    entry = {"callable": callable(attr)}
+    if not entry["callable"] and isinstance(attr, manifest_value_types):
+        entry["value"] = attr
+    return entry
+
+
+def _get_stored_data():
+    global stored_data
+
+    if stored_data is None:
+        from autogoal_contrib import find_classes
+
+        if exposed_contribs is None:
+            classes = find_classes()
+        else:
+            modules = [
+                importlib.import_module(f"autogoal_{c}") for c in exposed_contribs
+            ]
+            classes = find_classes(modules=modules)
+
+        if exposed_classes is not None:
+            classes = [c for c in classes if c.__name__ in exposed_classes]
+
+        stored_data = classes
+    return stored_data
+
 
+def _get_catalog():
+    """
+    Describes every exposed algorithm, versioned by a hash of its contents.
+    """
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is not None:
+            return _catalog
+
+        stored_data = _get_stored_data()
+        remote_algorithms = [
+            RemoteAlgorithmDTO.from_local_class(a).dict() for a in stored_data
+        ]
+        _catalog = {
+            "message": f"Exposing {str(len(stored_data))} algorithms: {', '.join([a.__name__ for a in stored_data])}",
+            "algorithms": remote_algorithms,
+            "etag": hashlib.blake2b(
+                json.dumps(remote_algorithms, sort_keys=True).encode(), digest_size=16
+            ).hexdigest(),
+        }
+    return _catalog
+
+
+def _get_algorithms(etag: str = None):
+    # clients holding the current version of the catalog don't need it again
+    catalog = _get_catalog()
+    if etag is not None and etag == catalog["etag"]:
+        return {"etag": etag, "unchanged": True}
+    return catalog
+
+
+def _instantiate(algorithm_dto: dict, args, kwargs, instance_id: str = None):
+    dto = RemoteAlgorithmDTO.parse_obj(algorithm_dto)
+    cls = dto.get_local_class()
+    new_id = uuid.uuid4() if instance_id is None else uuid.UUID(instance_id, version=4)
+    algorithm_pool[new_id] = cls(*args, **kwargs)
+    return new_id
+
+
+def _call(
+    id: uuid.UUID, inst, attr_name: str, args, kwargs, runner=None, isolated=False
+):
+    attr = getattr(inst, attr_name)
+    if not hasattr(attr, "__call__"):
+        return attr
+
+    if isolated:
+        # like restricted runners, calls made in a worker under its limits work on
+        # a copy, so one that fails leaves the instance as it was
+        ninstance = copy.deepcopy(inst)
+        with metrics.timer("autogoal_remote_compute_seconds", kind="call"):
+            result = dynamic_call(ninstance, attr_name, *args, **kwargs)
+        algorithm_pool[id] = ninstance
+        return result
+
+    if runner is None:
+        with metrics.timer("autogoal_remote_compute_seconds", kind="call"):
+            return dynamic_call(inst, attr_name, *args, **kwargs)
+
+    # restricted runners work on a copy of the instance and hand back its new state
+    with metrics.timer("autogoal_remote_compute_seconds", kind="call"):
+        result, ninstance = runner(inst, attr_name, *args, **kwargs)
+    if ninstance is not None:
+        algorithm_pool[id] = ninstance
+
+    return result
+
+
+def _has_attr(instance_id: str, attr_name: str, trace: dict = None):
+    timings = {} if trace is not None else None
+    with _use_instance(instance_id, changed=False) as (_, inst):
+        with tracing.timed(timings, "call"):
+            try:
+                attr = getattr(inst, attr_name)
+                result = True
+            except:
+                result = False
+
+    response = {"exists": result, "is_callable": result and hasattr(attr, "__call__")}
+    if timings is not None:
+        response["timings"] = timings
+    return response
+
+
+def _delete(raw_id: str):
     id = uuid.UUID(raw_id, version=4)
+    object_store.release_owner(id)
+    _manifests.pop(id, None)
 
     try:
-        algorithm_pool.pop(id)
+        del algorithm_pool[id]
     except KeyError:
         # do nothing, key is already out of the pool. Dont ask that many questions...
         pass
 
-    await websocket.send_json({"message": f"deleted instance with id={id}"})
+    return {"message": f"deleted instance with id={id}"}
+
+
+def _session_instantiate(
+    algorithm_dto: dict,
+    args: list,
+    kwargs: list,
+    instance_id: str = None,
+    trace: dict = None,
+):
+    timings = {} if trace is not None else None
+
+    with metrics.timer(
+        "autogoal_remote_serialization_seconds", op="loads"
+    ), tracing.timed(timings, "loads"):
+        args, kwargs = loads_buffers(args), loads_buffers(kwargs)
+
+    with metrics.timer(
+        "autogoal_remote_compute_seconds", kind="instantiate"
+    ), tracing.timed(timings, "call"):
+        new_id = _instantiate(algorithm_dto, args, kwargs, instance_id)
+    with algorithm_pool.use(new_id, changed=False) as inst:
+        response = {
+            "message": "success",
+            "id": str(new_id),
+            "manifest": _manifest(inst, new_id),
+        }
+
+    if timings is not None:
+        response["timings"] = timings
+    return response
+
+
+def _session_call(
+    instance_id: str,
+    attr: str,
+    args: list,
+    kwargs: list,
+    manifest_version=None,
+    inband=False,
+    runner=None,
+    keep=False,
+    refs=None,
+    trace=None,
+    isolated=False,
+):
+    timings = {} if trace is not None else None
+
+    with _use_instance(instance_id, attr not in _reads) as (id, inst):
+        with metrics.timer(
+            "autogoal_remote_serialization_seconds", op="loads"
+        ), tracing.timed(timings, "loads"):
+            args = loads_buffers(args, _load_ref)
+            kwargs = loads_buffers(kwargs, _load_ref)
+
+        with tracing.timed(timings, "call"):
+            result = _call(id, inst, attr, args, kwargs, runner, isolated)
+
+        if keep:
+            # the result stays here, the client only gets a handle to it
+            ref_id = uuid.uuid4().hex
+            object_store.put(ref_id, id, result)
+            response = {
+                "ref": {"id": ref_id, "owner": str(id), "type": type(result).__name__}
+            }
+        else:
+            with metrics.timer(
+                "autogoal_remote_serialization_seconds", op="dumps"
+            ), tracing.timed(timings, "dumps"):
+                response = {
+                    "result": BufferList(
+                        [dumps_binary(result)] if inband else dumps_buffers(result)
+                    )
+                }
+
+        # any call may have added or removed attributes, so the client gets a fresh
+        # manifest whenever the one it holds is outdated.
+        if manifest_version is not None:
+            # restricted calls replace the instance with the state they left it in
+            manifest = _manifest(algorithm_pool[id], id)
+            if manifest["version"] != manifest_version:
+                response["manifest"] = manifest
+
+    if timings is not None:
+        response["timings"] = timings
+    return response
+
+
+def _load_ref(pid):
+    tag, ref_id = pid
+    if tag != REF_TAG:
+        raise Exception(f"Unknown persistent id {pid}")
+    return object_store.get(ref_id)
+
+
+def _fetch_ref(ref_id: str):
+    return {"result": BufferList(dumps_buffers(object_store.get(ref_id)))}
+
+
+def _release_ref(ref_id: str):
+    object_store.release(ref_id)
+    return {"message": f"released reference {ref_id}"}
+
+
+def _import_ref(ref_id: str, owner: str, value: list):
+    object_store.put(ref_id, uuid.UUID(owner, version=4), loads_buffers(value))
+    return {"message": f"imported reference {ref_id}"}
+
+
+def _missing_refs(refs: list):
+    return {"missing": [ref_id for ref_id in refs if ref_id not in object_store]}
+
+
+# operations on instances. They run where the instances live, see `execution_mode`.
+instance_operations = {
+    "instantiate": _session_instantiate,
+    "call": _session_call,
+    "has_attr": _has_attr,
+    "delete": _delete,
+}
+
+# operations on kept results, run where their owner lives. Results used by an
+# instance living in another worker are copied there first, owned by that instance.
+ref_operations = {
+    "fetch_ref": _fetch_ref,
+    "release_ref": _release_ref,
+    "import_ref": _import_ref,
+    "missing_refs": _missing_refs,
+}
+
+worker_operations = {**instance_operations, **ref_operations}
+
+
+def _worker_status() -> dict:
+    return {**algorithm_pool.stats(), **object_store.stats()}
+
+
+def _get_worker_pool(initializer=None) -> WorkerPool:
+    global _worker_pool
+
+    if _worker_pool is None:
+        _worker_pool = WorkerPool(
+            worker_operations,
+            worker_count,
+            remote_call_memory_limit,
+            _worker_status,
+            initializer,
+        )
+    return _worker_pool
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            execution_threads, thread_name_prefix="autogoal-remote-call"
+        )
+    return _executor
+
+
+async def _execute(worker: Worker, op: str, request: dict, restricted=False):
+    """
+    Runs an instance operation off the event loop, in `worker` if given or in this
+    process otherwise.
+    """
+    if worker is not None:
+        timeout = remote_call_timeout if restricted else None
+        if restricted:
+            request = dict(request, isolated=True)
+        func = partial(worker.request, op, request, timeout, restricted)
+    else:
+        if restricted:
+            # built here since RestrictedWorker installs signal handlers, which
+            # is only allowed in the main thread.
+            request = dict(
+                request,
+                runner=RestrictedWorkerWithState(
+                    dynamic_call, remote_call_timeout, remote_call_memory_limit
+                ),
+            )
+        func = partial(worker_operations[op], **request)
+
+    try:
+        return await asyncio.get_event_loop().run_in_executor(_get_executor(), func)
+    except TimeoutError:
+        # in "process" mode the worker already counted it
+        if worker is None:
+            metrics.inc("autogoal_remote_restricted_failures_total", reason="timeout")
+        raise
+    except MemoryError:
+        metrics.inc("autogoal_remote_restricted_failures_total", reason="memory")
+        raise
+
+
+def _payload_size(message: dict) -> int:
+    # binary values make up for most of any sizable message
+    size = 0
+    for value in message.values():
+        if isinstance(value, BufferList):
+            size += sum(memoryview(v).nbytes for v in value)
+        elif is_binary(value):
+            size += memoryview(value).nbytes
+    return size
+
+
+def _pool_metrics():
+    if _worker_pool is not None:
+        stats = [w.status for w in _worker_pool.workers if w.status is not None]
+    else:
+        stats = [_worker_status()]
+
+    names = {
+        "instances": "autogoal_remote_pool_instances",
+        "in_memory": "autogoal_remote_pool_instances_in_memory",
+        "spilled": "autogoal_remote_pool_instances_spilled",
+        "memory": "autogoal_remote_pool_memory_bytes",
+        "objects": "autogoal_remote_kept_results",
+        "object_memory": "autogoal_remote_kept_results_bytes",
+    }
+    return [
+        (name, {}, sum(s.get(key, 0) for s in stats)) for key, name in names.items()
+    ]
+
+
+metrics.register_collector(_pool_metrics)
+
+
+def _admission_metrics():
+    names = {
+        "running": "autogoal_remote_admission_running",
+        "queued": "autogoal_remote_admission_queued",
+        "reserved": "autogoal_remote_admission_reserved_bytes",
+        "rejected": "autogoal_remote_admission_rejected",
+    }
+    stats = _admission.stats()
+    return [(name, {}, stats[key]) for key, name in names.items()]
+
+
+metrics.register_collector(_admission_metrics)
+
+
+async def _dispatch(op: str, request: dict) -> dict:
+    """
+    Runs a request from a client. Requests on the same instance run one at a time,
+    requests on different instances run in parallel.
+    """
+    if op == "get-algorithms":
+        # the first request may have to import every exposed contrib
+        return await asyncio.get_event_loop().run_in_executor(
+            _get_executor(), partial(_get_algorithms, **request)
+        )
+    if op == "batch":
+        return await _session_batch(**request)
+    if op == "load":
+        return _get_load()
+    if op in ("fetch_ref", "release_ref"):
+        return await _dispatch_ref(op, request)
+    if op not in instance_operations:
+        raise Exception(f"Unknown operation {op}")
+
+    global _in_flight
+
+    _in_flight += 1
+    try:
+        return await _dispatch_instance(op, request)
+    finally:
+        _in_flight -= 1
+
+
+async def _dispatch_instance(op: str, request: dict) -> dict:
+    pool = _get_worker_pool() if execution_mode == "process" else None
+    start = time.perf_counter()
+
+    async def execute(worker: Worker, restricted=False) -> dict:
+        if not request.get("trace"):
+            return await _execute(worker, op, request, restricted)
+
+        # traced requests report how long they waited, and how long they ran
+        queue = time.perf_counter() - start
+        timings = {}
+        with tracing.timed(timings, "execute"):
+            response = await _execute(worker, op, request, restricted)
+        response.setdefault("timings", {}).update(queue=queue, **timings)
+        return response
+
+    if op == "instantiate":
+        new_id = uuid.uuid4()
+        request = dict(request, instance_id=str(new_id))
+        async with _admission.admit():
+            if pool is None:
+                return await execute(None)
+
+            # new instances go to the least busy worker
+            worker = pool.place()
+            pool.adopt(new_id, worker)
+            try:
+                response = await execute(worker)
+            except Exception:
+                pool.release(new_id)
+                raise
+
+        if "error" in response:
+            pool.release(new_id)
+        return response
+
+    id = uuid.UUID(request["raw_id" if op == "delete" else "instance_id"], version=4)
+
+    async with _instance_locks.setdefault(id, asyncio.Lock()):
+        if op == "delete":
+            refs = _instance_refs.pop(id, ())
+            for ref_id in refs:
+                _ref_owners.pop(ref_id, None)
+            if pool is None:
+                return await execute(None)
+
+            await _release_copies(pool, refs)
+            worker = pool.release(id)
+            if worker is None:
+                return {"message": f"deleted instance with id={id}"}
+            return await execute(worker)
+
+        worker = pool.owner(id) if pool is not None else None
+
+        # only `run` is restricted, as it always was
+        restricted = op == "call" and request["attr"] == "run"
+        if op != "call":
+            return await execute(worker, restricted)
+
+        if worker is not None and request.get("refs"):
+            await _import_refs(pool, worker, id, request["refs"])
+
+        # restricted calls may take up to their memory limit
+        memory = remote_call_memory_limit if restricted else 0
+        async with _admission.admit(memory):
+            response = await execute(worker, restricted)
+
+        if "ref" in response:
+            ref_id = response["ref"]["id"]
+            _ref_owners[ref_id] = id
+            _instance_refs.setdefault(id, set()).add(ref_id)
+        return response
+
+
+async def _import_refs(pool: WorkerPool, worker: Worker, id: uuid.UUID, refs: list):
+    """
+    Copies the kept results in `refs` that live in other workers into `worker`,
+    owned by the instance `id` about to use them.
+    """
+    foreign = []
+    for ref_id in refs:
+        owner = _ref_owners.get(ref_id)
+        if owner is None:
+            raise Exception(f"Remote reference {ref_id} not found")
+        if pool.owner(owner) is not worker:
+            foreign.append(ref_id)
+
+    if not foreign:
+        return
+
+    # copies made for earlier calls may still be there
+    response = await _execute(worker, "missing_refs", {"refs": foreign})
+    for ref_id in response["missing"]:
+        value = await _execute(
+            pool.owner(_ref_owners[ref_id]), "fetch_ref", {"ref_id": ref_id}
+        )
+        if "error" in value:
+            raise Exception(value["error"])
+
+        response = await _execute(
+            worker,
+            "import_ref",
+            {"ref_id": ref_id, "owner": str(id), "value": value["result"]},
+        )
+        if "error" in response:
+            raise Exception(response["error"])
+        _ref_copies.setdefault(ref_id, set()).add(id)
+
+
+async def _release_copies(pool: WorkerPool, refs):
+    """
+    Releases the copies of `refs` made in other workers.
+    """
+    for ref_id in refs:
+        workers = set()
+        for consumer in _ref_copies.pop(ref_id, ()):
+            try:
+                workers.add(pool.owner(consumer))
+            except Exception:
+                # lost along with the instance it was copied for
+                pass
+
+        for worker in workers:
+            await _execute(worker, "release_ref", {"ref_id": ref_id})
+
+
+async def _dispatch_ref(op: str, request: dict) -> dict:
+    ref_id = request["ref_id"]
+    owner = _ref_owners.get(ref_id)
+    if owner is None:
+        if op == "release_ref":
+            return {"message": f"released reference {ref_id}"}
+        raise Exception(f"Remote reference {ref_id} not found")
+
+    if op == "release_ref":
+        _ref_owners.pop(ref_id)
+        _instance_refs.get(owner, set()).discard(ref_id)
+
+    worker = None
+    if execution_mode == "process":
+        if op == "release_ref":
+            await _release_copies(_get_worker_pool(), [ref_id])
+        try:
+            worker = _get_worker_pool().owner(owner)
+        except Exception:
+            if op == "release_ref":
+                # lost along with its owner
+                return {"message": f"released reference {ref_id}"}
+            raise
+
+    return await _execute(worker, op, request)
+
+
+def _get_load() -> dict:
+    """
+    Describes how busy this server is, so clients can place new instances on the
+    least loaded of several replicas (see `ReplicaGroup`).
+    """
+    if _worker_pool is not None:
+        instances = len(_worker_pool.owners)
+    else:
+        instances = len(algorithm_pool)
+
+    return {
+        "in_flight": _in_flight,
+        "instances": instances,
+        "capacity": worker_count if execution_mode == "process" else execution_threads,
+    }
+
+
+# operations that can be part of a batch.
+batch_operations = ("instantiate", "call", "has_attr", "delete")
+
+
+async def _session_batch(operations: list, **blobs):
+    """
+    Runs `operations` in order and returns their results in `results`.
+
+    Binary values of operation `i` travel as `"{i}.{name}"`, both ways. Any
+    value of the form `{"ref": j}` is replaced by the id of the instance
+    created (or used) by operation `j`, so a batch can instantiate an
+    algorithm and call it right away.
+    """
+    response = {"results": []}
+    instance_ids = []
+
+    for index, operation in enumerate(operations):
+        operation = dict(operation)
+        op = operation.pop("op")
+        prefix = f"{index}."
+        for name, blob in blobs.items():
+            if name.startswith(prefix):
+                operation[name[len(prefix) :]] = blob
+
+        try:
+            if op not in batch_operations:
+                raise Exception(f"Operation {op} is not allowed in a batch")
+
+            for key, value in operation.items():
+                if isinstance(value, dict) and "ref" in value:
+                    if not 0 <= value["ref"] < index:
+                        raise Exception(
+                            f"Invalid reference to operation {value['ref']}"
+                        )
+
+                    ref_id = instance_ids[value["ref"]]
+                    if ref_id is None:
+                        raise Exception(
+                            f"Operation {value['ref']} did not produce an instance"
+                        )
+                    operation[key] = ref_id
+
+            result = await _dispatch(op, dict(operation))
+        except Overloaded as e:
+            result = {"error": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            result = {"error": str(e)}
+
+        if "error" in result:
+            instance_ids.append(None)
+        else:
+            instance_ids.append(
+                result.get("id")
+                or operation.get("instance_id")
+                or operation.get("raw_id")
+            )
+
+        header = {}
+        for key, value in result.items():
+            if is_binary(value):
+                response[f"{index}.{key}"] = value
+            else:
+                header[key] = value
+        response["results"].append(header)
+
+    return response
 
 
 # @app.websocket("/ws")
@@ -266,11 +1306,36 @@ async def delete_algorithm(websocket: WebSocket, raw_id):
 #         await websocket.send_text(f"Message text was: {data}")
 
 
-def run(ip=None, port=None):
+def run(ip=None, port=None, contribs=None, classes=None, lazy=False):
     """
-    Starts HTTP API with specified model.
+    Starts HTTP API exposing the algorithms from `contribs` (all installed ones by
+    default), optionally only those named in `classes`. With `lazy`, contribs are
+    imported on the first request for the catalog instead of on startup. Clients on
+    this same host may also reach it through a Unix socket (see `local_transport`).
     """
-    uvicorn.run(app, host=ip or "0.0.0.0", port=port or 8000)
+    global exposed_contribs, exposed_classes, lazy_catalog, _local_socket
+
+    exposed_contribs = contribs or exposed_contribs
+    exposed_classes = classes or exposed_classes
+    lazy_catalog = lazy or lazy_catalog
+
+    ip, port = ip or "0.0.0.0", port or 8000
+    if not (local_transport and local.available()):
+        uvicorn.run(app, host=ip, port=port)
+        return
+
+    # a single server answers on both sockets
+    config = uvicorn.Config(app, host=ip, port=port)
+    sockets = [config.bind_socket()]
+    unix_socket = local.bind(port)
+    if unix_socket is None:
+        return uvicorn.Server(config).run(sockets=sockets)
+
+    _local_socket = local.socket_path(port)
+    try:
+        uvicorn.Server(config).run(sockets=sockets + [unix_socket])
+    finally:
+        local.unbind(port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,379 @@
+"""
+Memory-bounded storage for algorithm instances.
+"""
+
+import collections
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import weakref
+from contextlib import contextmanager
+
+import dill
+
+
+def estimate_size(obj, limit: int = 1000, depth: int = 8, nodes: int = 10000) -> int:
+    """
+    Cheap estimate (in bytes) of the memory held by `obj` and what it references.
+
+    Buffers exposing `nbytes` (NumPy arrays, sparse matrix components) are counted
+    exactly. Containers are sampled up to `limit` items and extrapolated, and no
+    more than `nodes` objects are visited in total.
+    """
+    seen = set()
+    # shared by every instance, not held by any of them
+    skip = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+    def visit(obj, depth):
+        if id(obj) in seen or depth < 0 or isinstance(obj, skip):
+            return 0
+        if len(seen) >= nodes:
+            return 0
+        seen.add(id(obj))
+
+        try:
+            nbytes = getattr(obj, "nbytes", None)
+        except Exception:
+            nbytes = None
+        if isinstance(nbytes, int):
+            return nbytes
+
+        size = sys.getsizeof(obj, 0)
+
+        if isinstance(obj, dict):
+            sample = list(itertools.islice(obj.items(), limit))
+            inner = sum(visit(k, depth - 1) + visit(v, depth - 1) for k, v in sample)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            sample = list(itertools.islice(obj, limit))
+            inner = sum(visit(v, depth - 1) for v in sample)
+        else:
+            # plain objects (e.g. sparse matrices) hold their data in attributes
+            return size + visit(getattr(obj, "__dict__", None), depth - 1)
+
+        if sample:
+            inner = inner * len(obj) // len(sample)
+        return size + inner
+
+    return visit(obj, depth)
+
+
+# every store in this process, see `_reset_after_fork`.
+_stores = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    # a lock held by another thread (e.g. the collector) while forking would stay
+    # held forever in the child, so forked processes get new ones
+    for store in _stores:
+        if isinstance(store, InstanceStore):
+            store._lock = threading.RLock()
+        else:
+            store._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class InstanceStore:
+    """
+    Dict-like store of algorithm instances, bounded by a memory budget.
+
+    Instances are kept in LRU order together with an estimate of their size. When
+    the estimated total exceeds `memory_budget`, or an instance has not been used
+    for `idle_ttl` seconds, it is spilled to `spill_dir` with dill and transparently
+    loaded back on its next access. Instances being used (see `use`) are never
+    spilled. `None` disables the corresponding limit.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int = None,
+        idle_ttl: float = None,
+        spill_dir: str = None,
+        collect_interval: float = 10,
+    ):
+        self.memory_budget = memory_budget
+        self.idle_ttl = idle_ttl
+        self.spill_dir = spill_dir
+        self.collect_interval = collect_interval
+        self.memory = 0
+        self._instances = collections.OrderedDict()
+        self._sizes = {}
+        self._last_used = {}
+        self._spilled = {}
+        self._pinned = collections.Counter()
+        self._unspillable = set()
+        self._lock = threading.RLock()
+        self._collector_pid = None
+        _stores.add(self)
+
+    def configure(self, memory_budget=None, idle_ttl=None, spill_dir=None):
+        with self._lock:
+            self.memory_budget = memory_budget
+            self.idle_ttl = idle_ttl
+            self.spill_dir = spill_dir
+        self.collect()
+
+    def __len__(self):
+        return len(self._instances) + len(self._spilled)
+
+    def __contains__(self, key):
+        return key in self._instances or key in self._spilled
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._spilled:
+                self._load(key)
+
+            instance = self._instances[key]
+            self._touch(key)
+            return instance
+
+    def __setitem__(self, key, instance):
+        with self._lock:
+            self._discard(key)
+            self._instances[key] = instance
+            self._account(key)
+            self._touch(key)
+        self.collect()
+
+    def __delitem__(self, key):
+        # spilled instances are dropped along with their file, without loading them
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            self._discard(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key not in self:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+
+            instance = self[key]
+            self._discard(key)
+            return instance
+
+    @contextmanager
+    def use(self, key, changed: bool = True):
+        """
+        Yields the instance stored under `key`, keeping it in memory meanwhile. Its
+        size is estimated again afterwards, unless the caller tells it didn't
+        change it.
+        """
+        with self._lock:
+            instance = self[key]
+            self._pinned[key] += 1
+
+        try:
+            yield instance
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if self._pinned[key] <= 0:
+                    del self._pinned[key]
+                if key in self._instances:
+                    if changed:
+                        self._account(key)
+                    self._touch(key)
+            self.collect()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "instances": len(self),
+                "in_memory": len(self._instances),
+                "spilled": len(self._spilled),
+                "memory": self.memory,
+            }
+
+    def collect(self):
+        """
+        Spills idle instances, then least recently used ones until the estimated
+        memory fits in the budget.
+        """
+        with self._lock:
+            self._start_collector()
+            keys = list(self._instances)
+
+        if self.idle_ttl is not None:
+            deadline = time.monotonic() - self.idle_ttl
+            for key in keys:
+                if self._last_used.get(key, deadline) > deadline:
+                    break
+                self._spill(key)
+
+        if self.memory_budget is not None:
+            for key in keys:
+                if self.memory <= self.memory_budget:
+                    break
+                self._spill(key)
+
+    def _touch(self, key):
+        self._instances.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+
+    def _account(self, key):
+        size = estimate_size(self._instances[key])
+        self.memory += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _discard(self, key):
+        if key in self._instances:
+            del self._instances[key]
+            del self._last_used[key]
+            self.memory -= self._sizes.pop(key)
+
+        path = self._spilled.pop(key, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+        self._unspillable.discard(key)
+
+    def _spill(self, key):
+        with self._lock:
+            if key in self._pinned or key in self._unspillable:
+                return
+            instance = self._instances.get(key)
+            if instance is None:
+                return
+            last_used = self._last_used[key]
+
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="autogoal-remote-")
+            spill_dir = self.spill_dir
+
+        # serialized without holding the lock, which would block every other
+        # request meanwhile (and could be inherited held by forked workers)
+        os.makedirs(spill_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=f"{key}-", suffix=".pkl", dir=spill_dir)
+        try:
+            with open(fd, "wb") as file:
+                dill.dump(instance, file)
+        except MemoryError:
+            # e.g. a restricted call's memory limit, the next collection tries again
+            os.remove(path)
+            return
+        except Exception:
+            # not every instance can be serialized, those stay in memory
+            os.remove(path)
+            with self._lock:
+                self._unspillable.add(key)
+            return
+
+        with self._lock:
+            # used (or replaced) while being serialized, so it stays
+            if (
+                self._instances.get(key) is not instance
+                or self._last_used[key] != last_used
+                or key in self._pinned
+            ):
+                os.remove(path)
+                return
+
+            self._discard(key)
+            self._spilled[key] = path
+
+    def _load(self, key):
+        path = self._spilled.pop(key)
+        with open(path, "rb") as fd:
+            instance = dill.load(fd)
+        os.remove(path)
+
+        self._instances[key] = instance
+        self._account(key)
+        self._touch(key)
+
+    def _start_collector(self):
+        # idle instances are only spilled by a background thread. It is started on
+        # first use, and again in forked processes, where it doesn't survive.
+        if self.idle_ttl is None or self._collector_pid == os.getpid():
+            return
+
+        self._collector_pid = os.getpid()
+        threading.Thread(
+            target=self._collect_periodically,
+            name="autogoal-remote-store",
+            daemon=True,
+        ).start()
+
+    def _collect_periodically(self):
+        pid = os.getpid()
+        while self._collector_pid == pid:
+            time.sleep(self.collect_interval)
+            self.collect()
+
+
+class ObjectStore:
+    """
+    Values kept on the server on behalf of clients (see `RemoteRef`). Every value is
+    owned by an algorithm instance and dropped along with it, if not released before.
+    """
+
+    def __init__(self):
+        self.memory = 0
+        self._objects = {}
+        self._owners = {}
+        self._owned = collections.defaultdict(set)
+        self._sizes = {}
+        self._lock = threading.Lock()
+        _stores.add(self)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, ref_id):
+        return ref_id in self._objects
+
+    def get(self, ref_id: str):
+        try:
+            return self._objects[ref_id]
+        except KeyError:
+            raise Exception(f"Remote reference {ref_id} not found") from None
+
+    def put(self, ref_id: str, owner, value):
+        with self._lock:
+            self._release(ref_id)
+            self._objects[ref_id] = value
+            self._owners[ref_id] = owner
+            self._owned[owner].add(ref_id)
+            self._sizes[ref_id] = estimate_size(value)
+            self.memory += self._sizes[ref_id]
+
+    def release(self, ref_id: str):
+        with self._lock:
+            self._release(ref_id)
+
+    def release_owner(self, owner):
+        """
+        Drops every value owned by `owner`.
+        """
+        with self._lock:
+            for ref_id in self._owned.pop(owner, ()):
+                self._release(ref_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"objects": len(self._objects), "object_memory": self.memory}
+
+    def _release(self, ref_id: str):
+        if ref_id not in self._objects:
+            return
+
+        del self._objects[ref_id]
+        owner = self._owners.pop(ref_id)
+        self._owned[owner].discard(ref_id)
+        if not self._owned[owner]:
+            del self._owned[owner]
+        self.memory -= self._sizes.pop(ref_id)
@@ -1,26 +1,43 @@
-from typing import Callable
-from fastapi import WebSocket
+from typing import TYPE_CHECKING, Callable
 from functools import wraps
 import json
+import struct
+from autogoal_remote.distributed import local
+from autogoal_remote.distributed.compression import (
+    compress,
+    decompress,
+    default_threshold,
+)
 
+if TYPE_CHECKING:
+    # only for annotations, so clients don't import the server stack
+    from fastapi import WebSocket
 
-async def send_large_message(websocket: WebSocket, data: str, chunk_size: int):
+
+async def send_large_message(
+    websocket: "WebSocket", data: str, chunk_size: int, codec: str = None
+):
     async def send(data):
         func = (
             websocket.send_text if hasattr(websocket, "send_text") else websocket.send
         )
         return await func(json.dumps(data))
 
+    header = {"type": "chunk_count"}
+    if codec is not None:
+        data = compress(data.encode(), codec).decode("latin1")
+        header["codec"] = codec
+
     # Split the data into chunks
     chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
     # Send the number of chunks to the client
-    await send({"type": "chunk_count", "count": len(chunks)})
+    await send({**header, "count": len(chunks)})
     # Send each chunk separately
     for chunk in chunks:
         await send({"type": "chunk", "data": chunk})
 
 
-async def receive_large_message(websocket: WebSocket):
+async def receive_large_message(websocket: "WebSocket"):
     async def receive():
         func = (
             websocket.receive_text
@@ -33,6 +50,7 @@ async def receive_large_message(websocket: WebSocket):
     message = await receive()
     assert message["type"] == "chunk_count"
     chunk_count = message["count"]
+    codec = message.get("codec")
     # Receive each chunk separately
     chunks = []
     for _ in range(chunk_count):
@@ -41,4 +59,170 @@ async def receive_large_message(websocket: WebSocket):
         chunks.append(message["data"])
     # Reassemble the original message
     data = "".join(chunks)
+    if codec is not None:
+        data = decompress(data.encode("latin1"), codec).decode()
     return data
+
+
+#####################
+#  Binary framing   #
+#####################
+
+# Every binary frame starts with the id of the message it belongs to and its kind.
+# The first frame of a message holds a JSON header, the following ones hold raw
+# payload bytes. Since frames are tagged, frames of different messages can be
+# interleaved over the same websocket.
+FRAME_PREFIX = struct.Struct("!QB")
+HEADER_FRAME = 0
+DATA_FRAME = 1
+
+# default size (in bytes) of the payload carried by a single data frame.
+frame_size = 1 << 20
+
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+
+class BufferList(list):
+    """
+    A list of bytes-like values sent as consecutive payloads of a single message
+    value, e.g. the frames returned by `dumps_buffers`.
+    """
+
+
+def is_binary(value) -> bool:
+    return isinstance(value, BINARY_TYPES) or isinstance(value, BufferList)
+
+
+async def send_message(
+    websocket: "WebSocket",
+    message_id: int,
+    message: dict,
+    size: int = None,
+    codec: str = None,
+    threshold: int = None,
+    shared: int = None,
+) -> list:
+    """
+    Sends `message` as a sequence of binary frames.
+
+    Values of `message` that are bytes-like (or a `BufferList` of them) are streamed
+    as raw payload in frames of at most `size` bytes, everything else goes in the
+    JSON header. If a `codec` is given, payloads of at least `threshold` bytes are
+    compressed with it.
+
+    Over same-host connections, payloads of at least `shared` bytes are copied to
+    shared memory instead, and only their segment name is sent. The segments are
+    returned, see `local.hand_over` and `local.discard`.
+    """
+    func = websocket.send_bytes if hasattr(websocket, "send_bytes") else websocket.send
+    size = size or frame_size
+
+    header = {}
+    blobs = []
+    for key, value in message.items():
+        if isinstance(value, BufferList):
+            for part, buffer in enumerate(value):
+                blobs.append(
+                    ({"name": key, "part": part}, memoryview(buffer).cast("B"))
+                )
+        elif isinstance(value, BINARY_TYPES):
+            blobs.append(({"name": key}, memoryview(value).cast("B")))
+        else:
+            header[key] = value
+
+    if codec is not None:
+        threshold = default_threshold if threshold is None else threshold
+        for i, (blob, view) in enumerate(blobs):
+            if view.nbytes >= threshold:
+                blobs[i] = (dict(blob, codec=codec), memoryview(compress(view, codec)))
+
+    segments = []
+    try:
+        if shared is not None:
+            for i, (blob, view) in enumerate(blobs):
+                if view.nbytes >= max(shared, 1):
+                    segments.append(local.share(view))
+                    blobs[i] = (dict(blob, shm=segments[-1].name), view)
+
+        header["blobs"] = [dict(blob, size=view.nbytes) for blob, view in blobs]
+        await func(
+            FRAME_PREFIX.pack(message_id, HEADER_FRAME) + json.dumps(header).encode()
+        )
+
+        prefix = FRAME_PREFIX.pack(message_id, DATA_FRAME)
+        for blob, view in blobs:
+            if "shm" in blob:
+                continue
+            for start in range(0, view.nbytes, size):
+                await func(prefix + view[start : start + size])
+    except BaseException:
+        local.discard(segments)
+        raise
+
+    return segments
+
+
+class MessageAssembler:
+    """
+    Rebuilds messages sent by `send_message` as their frames arrive.
+
+    Payload buffers are allocated once from the sizes in the header and filled in
+    place, so a message never takes much more memory than its payload. Payloads sent
+    through shared memory are used in place, if `shared` allows them. The names of
+    the segments opened are added to `opened`, for the sender to forget about them.
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        self.opened = []
+        self._partial = {}
+
+    def feed(self, frame: bytes):
+        """
+        Consumes a frame. Returns `(message_id, message)` once a message is
+        complete and `None` otherwise.
+        """
+        message_id, kind = FRAME_PREFIX.unpack_from(frame)
+        body = memoryview(frame)[FRAME_PREFIX.size :]
+
+        if kind == HEADER_FRAME:
+            header = json.loads(bytes(body))
+            blobs = [(b, self._allocate(b)) for b in header.pop("blobs")]
+            state = self._partial[message_id] = [header, blobs, 0, 0]
+        else:
+            state = self._partial[message_id]
+            header, blobs, index, offset = state
+            _, buffer = blobs[index]
+            buffer[offset : offset + len(body)] = body
+            state[3] = offset + len(body)
+
+        # skip over every buffer that is already full (including empty and shared ones)
+        header, blobs, index, offset = state
+        while index < len(blobs) and (
+            offset == len(blobs[index][1]) or "shm" in blobs[index][0]
+        ):
+            index, offset = index + 1, 0
+        state[2], state[3] = index, offset
+
+        if index < len(blobs):
+            return None
+
+        del self._partial[message_id]
+        for blob, buffer in blobs:
+            if "codec" in blob:
+                buffer = decompress(buffer, blob["codec"])
+            if "part" in blob:
+                header.setdefault(blob["name"], BufferList()).append(buffer)
+            else:
+                header[blob["name"]] = buffer
+        return message_id, header
+
+    def _allocate(self, blob: dict):
+        if "shm" not in blob:
+            return bytearray(blob["size"])
+        if not self.shared:
+            raise Exception("Shared memory payloads are only accepted from this host")
+
+        view = local.open_shared(blob["shm"], blob["size"])
+        self.opened.append(blob["shm"])
+        return view
@@ -0,0 +1,346 @@
+"""
+Long-lived worker processes hosting algorithm instances.
+
+Instances are created inside a worker and stay there, so calls only move their
+arguments and results between processes instead of the whole instance state.
+
+Workers are never forked from the server itself, whose threads (the event loop,
+executor threads, background collectors) could hold locks that would then stay
+held forever in the worker. A spawner process is forked instead when the pool is
+created, before the server starts any thread, and forks every worker from then on.
+"""
+
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+import traceback
+import uuid
+from contextlib import contextmanager
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Callable, Dict
+
+from autogoal_remote import metrics
+from autogoal_remote.distributed.utils import BINARY_TYPES, BufferList
+
+
+def _send(connection, message: dict):
+    # the header goes pickled, binary values follow as raw messages
+    header = {}
+    layout = []
+    buffers = []
+    for key, value in message.items():
+        if isinstance(value, BufferList):
+            for part, buffer in enumerate(value):
+                buffers.append(memoryview(buffer).cast("B"))
+                layout.append((key, part, buffers[-1].nbytes))
+        elif isinstance(value, BINARY_TYPES):
+            buffers.append(memoryview(value).cast("B"))
+            layout.append((key, None, buffers[-1].nbytes))
+        else:
+            header[key] = value
+
+    connection.send((header, layout))
+    for buffer in buffers:
+        connection.send_bytes(buffer)
+
+
+def _recv(connection) -> dict:
+    header, layout = connection.recv()
+    for key, part, size in layout:
+        buffer = bytearray(size)
+        connection.recv_bytes_into(buffer)
+        if part is None:
+            header[key] = buffer
+        else:
+            header.setdefault(key, BufferList()).append(buffer)
+    return header
+
+
+def _address_space() -> int:
+    with open("/proc/self/statm") as fd:
+        return int(fd.read().split()[0]) * resource.getpagesize()
+
+
+@contextmanager
+def _limit_memory(limit: int):
+    """
+    Lets the current process grow by at most `limit` bytes while inside the block.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    target = _address_space() + limit
+    if hard != resource.RLIM_INFINITY:
+        target = min(target, hard)
+
+    resource.setrlimit(resource.RLIMIT_AS, (target, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def _serve(
+    connection,
+    operations: Dict[str, Callable],
+    memory_limit: int,
+    status: Callable = None,
+):
+    while True:
+        try:
+            request = _recv(connection)
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        op = request.pop("op")
+        restricted = request.pop("restricted")
+
+        try:
+            if restricted and memory_limit:
+                with _limit_memory(memory_limit):
+                    response = operations[op](**request)
+            else:
+                response = operations[op](**request)
+        except MemoryError:
+            # the heap may be left in any state, ask the parent for a fresh process
+            response = {
+                "error": f"Remote call exceeded the memory limit of {memory_limit} bytes",
+                "recycle": True,
+            }
+        except Exception as e:
+            response = {"error": str(e)}
+
+        # metrics recorded here are reported by the parent process
+        response["metrics"] = metrics.drain()
+        if status is not None:
+            response["status"] = status()
+
+        _send(connection, response)
+
+
+def _spawn(
+    connection,
+    operations: Dict[str, Callable],
+    memory_limit: int,
+    status: Callable,
+    initializer: Callable,
+):
+    # workers are reaped as soon as they exit, but start with the default handling
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        try:
+            connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        ours, theirs = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            connection.close()
+            ours.close()
+            code = 0
+            try:
+                if initializer is not None:
+                    initializer()
+                _serve(theirs, operations, memory_limit, status)
+            except BaseException:
+                code = 1
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+
+        theirs.close()
+        connection.send(pid)
+        reduction.send_handle(connection, ours.fileno(), os.getppid())
+        ours.close()
+
+
+class Spawner:
+    """
+    A process forked from this one, which forks workers on request. Create it while
+    this process has no other thread, see the module docstring. `initializer` runs
+    in every worker before it starts serving.
+    """
+
+    def __init__(
+        self,
+        operations: Dict[str, Callable],
+        memory_limit: int,
+        status: Callable = None,
+        initializer: Callable = None,
+    ):
+        context = multiprocessing.get_context("fork")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=_spawn,
+            args=(child, operations, memory_limit, status, initializer),
+            name="autogoal-remote-spawner",
+        )
+        self.process.start()
+        child.close()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Returns the pid of a new worker and a connection to it.
+        """
+        with self._lock:
+            self.connection.send("start")
+            pid = self.connection.recv()
+            connection = Connection(reduction.recv_handle(self.connection))
+        return pid, connection
+
+    def close(self):
+        self.connection.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class Worker:
+    """
+    A process hosting algorithm instances, started by `spawner`. Serves one request
+    at a time, requests from several threads wait for their turn. The worker status
+    returned along with every response is kept in `status`.
+    """
+
+    def __init__(self, spawner: Spawner):
+        self.spawner = spawner
+        self.status = None
+        self.instances = set()
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self.pid, self.connection = self.spawner.start()
+
+    def request(
+        self, op: str, message: dict, timeout: float = None, restricted=False
+    ) -> dict:
+        """
+        Runs `op` in the worker. Restricted requests are subject to the memory limit.
+        The worker is recycled if it dies, breaches its limits or takes longer than
+        `timeout` seconds.
+        """
+        with self._lock:
+            try:
+                _send(self.connection, {"op": op, "restricted": restricted, **message})
+                ready = self.connection.poll(timeout)
+                response = _recv(self.connection) if ready else None
+            except (EOFError, OSError):
+                lost = self.recycle()
+                raise Exception(
+                    f"Worker process died while serving the request. {lost}"
+                )
+
+            if response is None:
+                lost = self.recycle()
+                metrics.inc(
+                    "autogoal_remote_restricted_failures_total", reason="timeout"
+                )
+                raise TimeoutError(
+                    f"Remote call exceeded the time limit of {timeout} seconds. {lost}"
+                )
+
+            metrics.merge(response.pop("metrics", None))
+            self.status = response.pop("status", self.status)
+
+            if response.pop("recycle", False):
+                lost = self.recycle()
+                metrics.inc(
+                    "autogoal_remote_restricted_failures_total", reason="memory"
+                )
+                response["error"] = f"{response['error']}. {lost}"
+
+            return response
+
+    def recycle(self) -> str:
+        """
+        Replaces the process with a fresh one. Hosted instances are lost, which the
+        returned message tells callers about.
+        """
+        lost = len(self.instances)
+        metrics.inc("autogoal_remote_lost_instances_total", lost)
+
+        self.close()
+        self.instances = set()
+        self.status = None
+        self._start()
+        return (
+            f"Its worker was restarted, and the {lost} instance(s) it hosted are lost"
+        )
+
+    def close(self):
+        self.connection.close()
+        try:
+            # the spawner reaps it
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class WorkerPool:
+    """
+    A fixed set of workers. Every instance lives in exactly one worker, chosen when
+    it is created, and all later requests on it are routed there. `status` is called
+    in a worker after every request, `initializer` when it starts.
+    """
+
+    def __init__(
+        self,
+        operations: Dict[str, Callable],
+        size: int,
+        memory_limit: int = None,
+        status: Callable = None,
+        initializer: Callable = None,
+    ):
+        self.spawner = Spawner(operations, memory_limit, status, initializer)
+        self.workers = [Worker(self.spawner) for _ in range(size)]
+        self.owners: Dict[uuid.UUID, Worker] = {}
+        self.lost = set()
+
+    def place(self) -> Worker:
+        """
+        Returns the worker that should host a new instance.
+        """
+        return min(self.workers, key=lambda w: len(w.instances))
+
+    def adopt(self, instance_id: uuid.UUID, worker: Worker):
+        worker.instances.add(instance_id)
+        self.owners[instance_id] = worker
+
+    def owner(self, instance_id: uuid.UUID) -> Worker:
+        worker = self.owners.get(instance_id)
+        if worker is not None and instance_id in worker.instances:
+            return worker
+
+        # the instance was hosted by a worker that got recycled since
+        if worker is not None:
+            self.owners.pop(instance_id)
+            self.lost.add(instance_id)
+        if instance_id in self.lost:
+            raise Exception(
+                f"Algorithm instance with id={instance_id} was lost when its worker was recycled"
+            )
+        raise Exception(f"Algorithm instance with id={instance_id} not found")
+
+    def release(self, instance_id: uuid.UUID):
+        """
+        Forgets an instance, returns the worker still hosting it (if any).
+        """
+        self.lost.discard(instance_id)
+        worker = self.owners.pop(instance_id, None)
+        if worker is None or instance_id not in worker.instances:
+            return None
+
+        worker.instances.discard(instance_id)
+        return worker
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.spawner.close()
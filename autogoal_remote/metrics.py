@@ -0,0 +1,293 @@
+"""
+Process-wide performance metrics, exposed by both servers on `/metrics`.
+
+Counters and histograms are kept in memory and rendered in the Prometheus text
+format, or summarized as JSON with `/metrics?format=json`. Worker processes ship
+what they recorded along with their responses (see `drain` and `merge`), so the
+server process reports for all of them.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# upper bounds of the histogram buckets for durations, in seconds.
+latency_buckets = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# upper bounds of the histogram buckets for payload sizes, in bytes.
+size_buckets = tuple(1024 * 4**i for i in range(11))
+
+_descriptions = {
+    "autogoal_remote_requests_total": "Requests served, by endpoint and status.",
+    "autogoal_remote_request_seconds": "Time spent serving requests, by endpoint.",
+    "autogoal_remote_serialization_seconds": "Time spent in loads/dumps.",
+    "autogoal_remote_compute_seconds": "Time spent in predict or remote calls.",
+    "autogoal_remote_payload_bytes": "Size of payloads received and sent.",
+    "autogoal_remote_restricted_failures_total": "Restricted calls killed by their limits.",
+    "autogoal_remote_lost_instances_total": "Instances lost along with the worker hosting them.",
+}
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, tuple], float] = {}
+_histograms: Dict[Tuple[str, tuple], list] = {}
+_collectors: List[Callable] = []
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, buckets=latency_buckets, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # [bounds, count per bucket (the last one unbounded), sum, count]
+            histogram = _histograms[key] = [buckets, [0] * (len(buckets) + 1), 0, 0]
+        histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """
+    Observes the time spent inside the block.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def register_collector(collector: Callable[[], List[Tuple[str, dict, float]]]):
+    """
+    Adds a function returning `(name, labels, value)` gauges, read on every scrape.
+    """
+    _collectors.append(collector)
+
+
+def drain() -> dict:
+    """
+    Returns everything recorded so far and forgets it, to be merged elsewhere.
+    """
+    global _counters, _histograms
+
+    with _lock:
+        counters, _counters = _counters, {}
+        histograms, _histograms = _histograms, {}
+    return {"counters": counters, "histograms": histograms}
+
+
+def _reset_after_fork():
+    # forked processes (e.g. workers) start empty, otherwise whatever the parent
+    # recorded before the fork would be drained and merged back into it again
+    global _lock, _counters, _histograms
+    _lock = threading.Lock()
+    _counters = {}
+    _histograms = {}
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def merge(data: dict):
+    """
+    Adds the result of `drain` (e.g. from a worker process) to this process.
+    """
+    if not data:
+        return
+
+    with _lock:
+        for key, value in data["counters"].items():
+            _counters[key] = _counters.get(key, 0) + value
+
+        for key, (buckets, counts, total, count) in data["histograms"].items():
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = [buckets, [0] * len(counts), 0, 0]
+            histogram[1] = [a + b for a, b in zip(histogram[1], counts)]
+            histogram[2] += total
+            histogram[3] += count
+
+
+def _gauges() -> list:
+    gauges = []
+    for collector in _collectors:
+        try:
+            gauges.extend(collector())
+        except Exception:
+            # a broken collector shouldn't take the rest of the metrics down
+            pass
+    return gauges
+
+
+def _format_labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (
+        str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, v in items
+    )
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+def render_prometheus() -> str:
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: (h[0], list(h[1]), h[2], h[3]) for k, h in _histograms.items()}
+
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in _descriptions:
+                lines.append(f"# HELP {name} {_descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+        describe(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, le=bound)} {cumulative}"
+            )
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for name, labels, value in _gauges():
+        describe(name, "gauge")
+        lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> dict:
+    """
+    JSON-friendly summary: counter values, and count, sum and mean of histograms.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: (h[2], h[3]) for k, h in _histograms.items()}
+
+    def label(name, labels):
+        return name + _format_labels(labels)
+
+    return {
+        "counters": {label(*key): value for key, value in counters.items()},
+        "histograms": {
+            label(*key): {"count": count, "sum": total, "mean": total / count}
+            for key, (total, count) in histograms.items()
+            if count
+        },
+        "gauges": {
+            label(name, sorted(labels.items())): value
+            for name, labels, value in _gauges()
+        },
+    }
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing every HTTP request, until its response is
+    completely sent. Request bodies are left untouched, so streaming endpoints keep
+    working.
+    """
+
+    def __init__(self, app, server: str):
+        self.app = app
+        self.server = server
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_measured(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            endpoint = _endpoint(scope)
+            inc(
+                "autogoal_remote_requests_total",
+                server=self.server,
+                endpoint=endpoint,
+                status=status[0],
+            )
+            observe(
+                "autogoal_remote_request_seconds",
+                time.perf_counter() - start,
+                server=self.server,
+                endpoint=endpoint,
+            )
+
+
+def _endpoint(scope) -> str:
+    # route templates rather than paths, so ids don't end up in labels
+    from starlette.routing import Match
+
+    for route in getattr(scope.get("app"), "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+def install(app, server: str):
+    """
+    Times every HTTP request served by `app` and adds the `/metrics` endpoint.
+    """
+    from fastapi import Response
+
+    app.add_middleware(MetricsMiddleware, server=server)
+
+    @app.get("/metrics")
+    async def metrics(format: str = "prometheus"):
+        """
+        Returns performance metrics in Prometheus text format, or as JSON.
+        """
+        if format == "json":
+            return summary()
+        return Response(render_prometheus(), media_type="text/plain; version=0.0.4")
@@ -1,2 +1,26 @@
-from autogoal_remote.production.server import *
+import importlib
+
 from autogoal_remote.production.client import *
+
+
+def __getattr__(name):
+    # the server (FastAPI app) is only imported when one of its names is used,
+    # e.g. `production.run`. Its names used to shadow the client ones.
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    server = importlib.import_module(f"{__name__}.server")
+    if name == "server":
+        return server
+    try:
+        return getattr(server, name)
+    except AttributeError:
+        pass
+
+    # other submodules are only attributes of the package once imported
+    try:
+        return importlib.import_module(f"{__name__}.{name}")
+    except ModuleNotFoundError as e:
+        if e.name != f"{__name__}.{name}":
+            raise
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
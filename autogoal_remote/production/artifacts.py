@@ -0,0 +1,196 @@
+"""
+Memory-mappable cache of loaded models.
+
+Loading an export with `AutoML.folder_load` rebuilds the model from the files in
+the export folder. The first load stores the resulting model in `cache_dir`,
+pickled with protocol 5 into a single file where every buffer (e.g. NumPy arrays)
+is kept out of band and aligned. Later loads map that file and rebuild arrays
+right over the mapping: nothing is read until used, and processes loading the
+same export share its pages through the page cache until they write to them.
+
+The cache is keyed by the files in the export folder and the versions of the
+packages the model is built from, so replacing either invalidates it. Models that
+can't be pickled are simply loaded every time.
+"""
+
+import hashlib
+import importlib.metadata
+import mmap
+import os
+import struct
+import sys
+import warnings
+from pathlib import Path
+from typing import Callable, Optional
+
+from autogoal_remote.distributed.remote_algorithm import dumps_buffers, loads_buffers
+
+# directory the artifacts are stored in, one folder per export. `None` stores
+# them in a `.autogoal-remote` folder inside the export itself.
+# Defaults to `autogoal-remote/models` in the user cache directory.
+cache_dir = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "autogoal-remote",
+    "models",
+)
+
+# distributions whose versions are part of the fingerprint, besides every
+# installed `autogoal*` one, since models pickled with other versions may not load
+# (or behave differently). Defaults to scikit-learn, numpy, scipy and pandas.
+fingerprint_packages = ["scikit-learn", "numpy", "scipy", "pandas"]
+
+MAGIC = b"AGRMODEL"
+FRAME_COUNT = struct.Struct("!I")
+FRAME_SPAN = struct.Struct("!QQ")
+
+# buffers start at multiples of this, so arrays mapped over them are aligned.
+ALIGNMENT = 64
+
+
+def artifact_path(path) -> Path:
+    """
+    Returns the artifact file for the export at `path`, in its current state.
+    """
+    path = Path(path)
+    if cache_dir is None:
+        directory = path / ".autogoal-remote"
+    else:
+        name = hashlib.blake2b(str(path.resolve()).encode(), digest_size=8)
+        directory = Path(cache_dir) / name.hexdigest()
+    return directory / f"model-{fingerprint(path)}.bin"
+
+
+def fingerprint(path) -> str:
+    """
+    Hash of the name, size and modification time of every file in the export, and
+    of the Python and package versions the artifact is pickled with.
+    """
+    path = Path(path)
+    digest = hashlib.blake2b(sys.version.encode(), digest_size=16)
+    for name, version in sorted(_versions().items()):
+        digest.update(f"{name}=={version}\n".encode())
+    for file in sorted(path.rglob("*")):
+        relative = file.relative_to(path)
+        if relative.parts[0] == ".autogoal-remote" or not file.is_file():
+            continue
+
+        stat = file.stat()
+        digest.update(f"{relative}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _versions() -> dict:
+    versions = dict.fromkeys(fingerprint_packages)
+    for dist in importlib.metadata.distributions():
+        name = (dist.metadata["Name"] or "").lower()
+        if name.startswith("autogoal") or name in versions:
+            versions[name] = dist.version
+    return versions
+
+
+def load(path, loader: Callable):
+    """
+    Returns the model exported at `path`, from its artifact if there is one and
+    from `loader(path)` otherwise. In the latter case the artifact is stored for
+    the next time, if possible. Models that fail to pickle leave a marker instead,
+    so later loads don't try again until the export changes.
+    """
+    file = artifact_path(path)
+    model = read(file)
+    if model is not None:
+        return model
+
+    model = loader(path)
+    marker = file.with_suffix(".failed")
+    if marker.exists():
+        return model
+
+    try:
+        write(file, model)
+    except OSError as e:
+        # e.g. a read-only export, which may be writable next time
+        warnings.warn(f"Model artifact not stored in {file}: {e}")
+    except Exception as e:
+        # e.g. a model holding unpicklable objects, which won't change
+        warnings.warn(f"Model artifact not stored in {file}: {e}")
+        try:
+            marker.parent.mkdir(parents=True, exist_ok=True)
+            marker.write_text(f"{e}\n")
+            _remove_others(marker)
+        except OSError:
+            pass
+    return model
+
+
+def read(file) -> Optional[object]:
+    """
+    Rebuilds the model stored in `file` over a private mapping of it, or returns
+    `None` if the file is missing or unreadable.
+    """
+    try:
+        with open(file, "rb") as fd:
+            # copy-on-write, so models may still write to their arrays
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        return loads_buffers(_frames(memoryview(data)))
+    except Exception as e:
+        warnings.warn(f"Ignoring unreadable model artifact {file}: {e}")
+        return None
+
+
+def write(file, model):
+    """
+    Stores `model` in `file`, replacing artifacts of previous versions of the export.
+    """
+    file = Path(file)
+    frames = [memoryview(f).cast("B") for f in dumps_buffers(model)]
+
+    # the header goes first, with the offset and size of every frame
+    offset = len(MAGIC) + FRAME_COUNT.size + FRAME_SPAN.size * len(frames)
+    spans = []
+    for frame in frames:
+        offset += -offset % ALIGNMENT
+        spans.append((offset, frame.nbytes))
+        offset += frame.nbytes
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    temp = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+    try:
+        with open(temp, "wb") as fd:
+            fd.write(MAGIC + FRAME_COUNT.pack(len(frames)))
+            fd.write(b"".join(FRAME_SPAN.pack(*span) for span in spans))
+            for (start, _), frame in zip(spans, frames):
+                fd.write(b"\0" * (start - fd.tell()))
+                fd.write(frame)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+
+    # readers only ever see complete artifacts
+    os.replace(temp, file)
+    _remove_others(file)
+
+
+def _remove_others(file: Path):
+    # artifacts and markers of previous versions of the export
+    for old in file.parent.glob("model-*"):
+        if old != file and old.suffix in (".bin", ".failed"):
+            old.unlink(missing_ok=True)
+
+
+def _frames(data: memoryview) -> list:
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("not a model artifact")
+
+    (count,) = FRAME_COUNT.unpack_from(data, len(MAGIC))
+    header = len(MAGIC) + FRAME_COUNT.size
+    frames = []
+    for i in range(count):
+        start, size = FRAME_SPAN.unpack_from(data, header + i * FRAME_SPAN.size)
+        if start + size > data.nbytes:
+            raise ValueError("truncated model artifact")
+        frames.append(data[start : start + size])
+    return frames
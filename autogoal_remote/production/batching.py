@@ -0,0 +1,160 @@
+"""
+Dynamic micro-batching of predictions.
+
+Requests arriving close together are merged into a single input, predicted at once
+and the prediction is split back among them. Inputs can be merged when they are
+all lists, all NumPy arrays with the same trailing shape and dtype, or all sparse
+matrices with the same number of columns. Anything else is predicted on its own.
+"""
+
+import asyncio
+from typing import Callable, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+
+def _batch_key(data):
+    """
+    Inputs with the same key can be merged together. `None` means they can't.
+    """
+    if isinstance(data, list):
+        return ("list",)
+    if np is not None and isinstance(data, np.ndarray) and data.ndim > 0:
+        return ("ndarray", data.shape[1:], data.dtype.str)
+    if sp is not None and sp.issparse(data):
+        return ("sparse", data.shape[1], data.dtype.str)
+    return None
+
+
+def _merge(inputs: list):
+    kind = _batch_key(inputs[0])[0]
+    if kind == "list":
+        return [x for data in inputs for x in data]
+    if kind == "ndarray":
+        return np.concatenate(inputs)
+    return sp.vstack(inputs, format=inputs[0].format)
+
+
+def _length(data) -> int:
+    # sparse matrices don't support `len`
+    return data.shape[0] if hasattr(data, "shape") else len(data)
+
+
+def _split(result, sizes: List[int]) -> list:
+    if _length(result) != sum(sizes):
+        raise ValueError(
+            f"Prediction has {_length(result)} items for {sum(sizes)} merged samples"
+        )
+
+    parts = []
+    offset = 0
+    for size in sizes:
+        parts.append(result[offset : offset + size])
+        offset += size
+    return parts
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent `predict` calls into batches of up to `max_batch_size`
+    samples, waiting at most `max_wait` seconds for a batch to fill up. Batches run
+    one at a time in a background thread, calls keep gathering meanwhile.
+
+    A failing batch is predicted again request by request, so only the requests
+    that actually fail get an error.
+    """
+
+    def __init__(self, predict: Callable, max_batch_size: int, max_wait: float):
+        self.predict_batch = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._worker = None
+
+    async def predict(self, data):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._serve())
+
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((data, future))
+        return await future
+
+    async def _serve(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = _size(batch[0][0])
+            deadline = loop.time() + self.max_wait
+
+            while size < self.max_batch_size:
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                batch.append(item)
+                size += _size(item[0])
+
+            await self._run(batch)
+
+    async def _run(self, batch: list):
+        groups = {}
+        for data, future in batch:
+            key = _batch_key(data)
+            if key is None:
+                await self._run_one(data, future)
+            else:
+                groups.setdefault(key, []).append((data, future))
+
+        loop = asyncio.get_event_loop()
+        for group in groups.values():
+            if len(group) == 1:
+                await self._run_one(*group[0])
+                continue
+
+            inputs = [data for data, _ in group]
+            try:
+                result = await loop.run_in_executor(
+                    None, self.predict_batch, _merge(inputs)
+                )
+                parts = _split(result, [_length(data) for data in inputs])
+            except Exception:
+                for data, future in group:
+                    await self._run_one(data, future)
+                continue
+
+            for (_, future), part in zip(group, parts):
+                if not future.done():
+                    future.set_result(part)
+
+    async def _run_one(self, data, future: asyncio.Future):
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(
+                None, self.predict_batch, data
+            )
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+
+def _size(data) -> int:
+    # inputs that can't be merged count as a single sample
+    return 1 if _batch_key(data) is None else _length(data)
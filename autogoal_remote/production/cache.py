@@ -0,0 +1,131 @@
+"""
+In-process cache of serialized predictions.
+"""
+
+import asyncio
+import collections
+import hashlib
+import os
+import time
+from typing import Awaitable, Callable
+
+
+def model_token(model) -> str:
+    """
+    Identifies a loaded model, so cached predictions never outlive it. Models
+    loaded from an export folder are also told apart by the folder modification
+    time, in case the export is replaced and loaded again.
+    """
+    path = getattr(model, "export_path", None)
+    try:
+        mtime = os.stat(path).st_mtime_ns if path is not None else None
+    except OSError:
+        mtime = None
+    return f"{id(model)}:{path}:{mtime}"
+
+
+class PredictionCache:
+    """
+    LRU cache of predictions keyed by a hash of the serialized input, bounded by
+    `max_entries` and `max_bytes` and expiring entries after `ttl` seconds (`None`
+    keeps them until evicted).
+
+    Identical requests arriving while the first one is still being predicted wait
+    for its prediction instead of running their own.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._model = None
+        self._token = None
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    async def get(
+        self, model, kind: str, data, compute: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        """
+        Returns the cached result of `kind` over the serialized input `data`, or
+        computes it with `compute`. Results are sized with `len` (e.g. bytes).
+        """
+        self._check_model(model)
+        key = (self._token, kind, hashlib.blake2b(data, digest_size=16).digest())
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            result, expires = entry
+            if expires is None or expires > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return result
+            self._discard(key)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = self._pending[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody else may be waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            self._store(key, result)
+        finally:
+            self._pending.pop(key, None)
+
+        return result
+
+    def _check_model(self, model):
+        # a different model makes every cached prediction stale
+        if model is not self._model:
+            token = model_token(model)
+            if token != self._token:
+                self.clear()
+            self._model = model
+            self._token = token
+
+    def _store(self, key, result):
+        if key in self._entries:
+            self._discard(key)
+
+        size = len(result)
+        if size > self.max_bytes:
+            return
+
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (result, expires)
+        self.size += size
+
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        result, _ = self._entries.pop(key)
+        self.size -= len(result)
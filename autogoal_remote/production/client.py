@@ -1,34 +1,397 @@
 import requests
+from requests.adapters import HTTPAdapter
 from pydantic import BaseModel
-from typing import Any
+from typing import Any, Iterable, Iterator, List, Optional
 from autogoal_remote.distributed.proxy import loads, dumps, encode, decode
+from autogoal_remote.distributed.compression import (
+    available_codecs,
+    compress,
+    decompress,
+    negotiate,
+)
+from autogoal_remote.distributed.remote_algorithm import (
+    dumps_buffers,
+    loads_buffers,
+    pack_frames,
+    unpack_frames,
+)
+from autogoal_remote.production.streaming import (
+    ERROR_FRAME,
+    FrameReader,
+    LineReader,
+    decode_chunk,
+    encode_chunk,
+    encode_record,
+)
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+import asyncio
+import http.client
 import json
+import os
+import socket
+import threading
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 
 class Body(BaseModel):
     values: Any
+    # codec `values` is compressed with, if any
+    codec: Optional[str] = None
+    # codecs the prediction may be compressed with, in order of preference
+    accept: Optional[List[str]] = None
+
+
+# keep-alive connections shared by the module-level functions, one pool per process.
+_session = None
+
+
+def _get_session() -> requests.Session:
+    global _session
+
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def _reset_after_fork():
+    # pooled sockets can't be shared with the parent process
+    global _session
+    _session = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 def get_input(ip: str = "localhost", port: int = 8000):
     base_url = f"http://{ip}:{port}"
-    response = requests.get(f"{base_url}/input")
+    response = _get_session().get(f"{base_url}/input")
     return response.json()
 
 
 def get_output(ip: str = "localhost", port: int = 8000):
     base_url = f"http://{ip}:{port}"
-    response = requests.get(f"{base_url}/output")
+    response = _get_session().get(f"{base_url}/output")
     return response.json()
 
 
 def get_inspect(ip: str = "localhost", port: int = 8000):
     base_url = f"http://{ip}:{port}"
-    response = requests.get(f"{base_url}/inspect")
+    response = _get_session().get(f"{base_url}/inspect")
+    return response.json()
+
+
+def get_ready(ip: str = "localhost", port: int = 8000) -> dict:
+    """
+    Returns the startup status of the server, see `/ready`.
+    """
+    base_url = f"http://{ip}:{port}"
+    response = _get_session().get(f"{base_url}/ready")
     return response.json()
 
 
-def post_eval(data, ip: str = "localhost", port: int = 8000):
+def post_eval(data, ip: str = "localhost", port: int = 8000, codec: str = None):
+    """
+    Returns the prediction of the served model over `data`. The input is compressed
+    with `codec` if given. The prediction may come back compressed with any of the
+    installed codecs.
+    """
+    base_url = f"http://{ip}:{port}"
+    response = _get_session().post(f"{base_url}/", json=_eval_body(data, codec))
+    return _eval_result(response.json())
+
+
+def post_eval_buffers(data, ip: str = "localhost", port: int = 8000):
+    """
+    Same as `post_eval`, but sends and receives arrays as raw pickle protocol 5
+    frames instead of latin1 text inside JSON.
+    """
     base_url = f"http://{ip}:{port}"
-    response = requests.post(f"{base_url}/", json=Body(values=dumps(data)).dict())
-    content = json.loads(response.content)
-    return loads(content["data"])
+    response = _get_session().post(
+        f"{base_url}/buffers",
+        data=_buffers_body(data),
+        headers={"Content-Type": "application/octet-stream"},
+        stream=True,
+    )
+    response.raise_for_status()
+    return loads_buffers(unpack_frames(_read_body(response)))
+
+
+def _eval_body(data, codec: str = None) -> dict:
+    values = dumps(data)
+    if codec is not None:
+        values = decode(compress(encode(values), codec))
+    return {"values": values, "codec": codec, "accept": available_codecs()}
+
+
+def _eval_result(content: dict):
+    data = content["data"]
+    if content.get("codec") is not None:
+        data = decode(decompress(encode(data), content["codec"]))
+    return loads(data)
+
+
+def _buffers_body(data) -> bytes:
+    return b"".join(pack_frames(dumps_buffers(data)))
+
+
+def post_eval_stream(
+    chunks: Iterable, ip: str = "localhost", port: int = 8000
+) -> Iterator:
+    """
+    Streams `chunks` of input to the served model and yields the prediction of each
+    one, in order, as soon as it arrives. Chunks are only taken from `chunks` when
+    the server is ready for them, so memory stays flat on both sides.
+    """
+    reader = FrameReader()
+    for data in _stream("application/octet-stream", chunks, encode_chunk, ip, port):
+        for kind, payload in reader.feed(data):
+            if kind == ERROR_FRAME:
+                raise Exception(f"Prediction Error (server-side). {payload.decode()}")
+            yield decode_chunk(payload)
+
+
+def post_eval_records(
+    records: Iterable, ip: str = "localhost", port: int = 8000
+) -> Iterator:
+    """
+    Streams JSON `records` to the served model as NDJSON and yields one prediction
+    per record as they arrive.
+    """
+    reader = LineReader()
+    for data in _stream(
+        "application/x-ndjson", records, lambda r: [encode_record(r)], ip, port
+    ):
+        for line in reader.feed(data):
+            record = json.loads(line)
+            if isinstance(record, dict) and "error" in record:
+                raise Exception(f"Prediction Error (server-side). {record['error']}")
+            yield record
+
+
+def _stream(content_type: str, items: Iterable, encode, ip: str, port: int):
+    # the body is uploaded from another thread while the response is read here, so
+    # predictions flow back while the input is still being sent.
+    connection = http.client.HTTPConnection(ip, port)
+    connection.putrequest("POST", "/stream")
+    connection.putheader("Content-Type", content_type)
+    connection.putheader("Transfer-Encoding", "chunked")
+    connection.endheaders()
+
+    failure = []
+
+    def upload():
+        try:
+            for item in items:
+                buffers = encode(item)
+                size = sum(memoryview(b).nbytes for b in buffers)
+                connection.send(f"{size:X}\r\n".encode())
+                for buffer in buffers:
+                    connection.send(buffer)
+                connection.send(b"\r\n")
+            connection.send(b"0\r\n\r\n")
+        except Exception as e:
+            failure.append(e)
+            # the server would otherwise wait for the rest of the body forever
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+    uploader = threading.Thread(target=upload, name="autogoal-remote-upload")
+    uploader.start()
+
+    stopped = False
+    try:
+        response = connection.getresponse()
+        if response.status != 200:
+            raise Exception(f"Prediction Error (server-side). {response.read()}")
+
+        while True:
+            data = response.read1(1 << 20)
+            if not data:
+                break
+            yield data
+    except GeneratorExit:
+        # the caller stopped early, failing uploads are expected then
+        stopped = True
+        raise
+    finally:
+        connection.close()
+        uploader.join()
+        if failure and not stopped:
+            raise failure[0]
+
+
+def _read_body(response: requests.Response):
+    """
+    Reads a streamed response into a single writable buffer, preallocated from
+    its `Content-Length` when available.
+    """
+    length = response.headers.get("content-length")
+    if length is None:
+        return bytearray(response.content)
+
+    body = bytearray(int(length))
+    offset = 0
+    for chunk in response.iter_content(1 << 20):
+        body[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return body
+
+
+class ProductionClient:
+    """
+    Client for a served model, keeping up to `pool_size` keep-alive connections.
+
+    Predictions travel as raw frames (see `post_eval_buffers`) unless `binary` is
+    off, in which case they go as JSON, compressed with `codec` if given. The model
+    input and output types are only requested once.
+    """
+
+    def __init__(
+        self,
+        ip: str = "localhost",
+        port: int = 8000,
+        binary: bool = True,
+        codec: str = None,
+        pool_size: int = 10,
+    ):
+        self.base_url = f"http://{ip}:{port}"
+        self.binary = binary
+        self.codec = codec
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+
+    @cached_property
+    def input(self):
+        return self.session.get(f"{self.base_url}/input").json()
+
+    @cached_property
+    def output(self):
+        return self.session.get(f"{self.base_url}/output").json()
+
+    def inspect(self):
+        return self.session.get(f"{self.base_url}/inspect").json()
+
+    def predict(self, data):
+        if not self.binary:
+            response = self.session.post(
+                f"{self.base_url}/", json=_eval_body(data, self.codec)
+            )
+            response.raise_for_status()
+            return _eval_result(response.json())
+
+        response = self.session.post(
+            f"{self.base_url}/buffers",
+            data=_buffers_body(data),
+            headers={"Content-Type": "application/octet-stream"},
+            stream=True,
+        )
+        response.raise_for_status()
+        return loads_buffers(unpack_frames(_read_body(response)))
+
+    def predict_many(self, inputs: Iterable, concurrency: int = None) -> list:
+        """
+        Predicts every input with up to `concurrency` requests in flight (by default,
+        as many as pooled connections). Returns the predictions in order.
+        """
+        with ThreadPoolExecutor(concurrency or self.pool_size) as executor:
+            return list(executor.map(self.predict, inputs))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncProductionClient:
+    """
+    Asyncio version of `ProductionClient`, built on `httpx` (install the `async`
+    extra). Awaiting `input()` or `output()` only hits the server the first time.
+    """
+
+    def __init__(
+        self,
+        ip: str = "localhost",
+        port: int = 8000,
+        binary: bool = True,
+        codec: str = None,
+        pool_size: int = 10,
+    ):
+        if httpx is None:
+            raise Exception("httpx is required by AsyncProductionClient")
+
+        self.binary = binary
+        self.codec = codec
+        self.pool_size = pool_size
+        self.client = httpx.AsyncClient(
+            base_url=f"http://{ip}:{port}",
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            timeout=None,
+        )
+        self._metadata = {}
+
+    async def _get_metadata(self, name: str):
+        if name not in self._metadata:
+            response = await self.client.get(f"/{name}")
+            self._metadata[name] = response.json()
+        return self._metadata[name]
+
+    async def input(self):
+        return await self._get_metadata("input")
+
+    async def output(self):
+        return await self._get_metadata("output")
+
+    async def inspect(self):
+        response = await self.client.get("/inspect")
+        return response.json()
+
+    async def predict(self, data):
+        if not self.binary:
+            response = await self.client.post("/", json=_eval_body(data, self.codec))
+            response.raise_for_status()
+            return _eval_result(response.json())
+
+        response = await self.client.post(
+            "/buffers",
+            content=_buffers_body(data),
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        response.raise_for_status()
+        return loads_buffers(unpack_frames(bytearray(response.content)))
+
+    async def predict_many(self, inputs: Iterable, concurrency: int = None) -> list:
+        """
+        Predicts every input with up to `concurrency` requests in flight (by default,
+        as many as pooled connections). Returns the predictions in order.
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.pool_size)
+
+        async def predict(data):
+            async with semaphore:
+                return await self.predict(data)
+
+        return await asyncio.gather(*(predict(data) for data in inputs))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
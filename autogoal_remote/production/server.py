@@ -1,17 +1,160 @@
-from typing import Any
-from fastapi import FastAPI, Response, Request
+import asyncio
+import gc
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, List, Optional
+from fastapi import FastAPI, HTTPException, Response, Request
+from fastapi.responses import StreamingResponse
 from pathlib import Path
 from pydantic import BaseModel
 from autogoal.utils._storage import inspect_storage
 import uvicorn
+from autogoal_remote import metrics
 from autogoal_remote.distributed.proxy import loads, dumps, encode, decode
+from autogoal_remote.distributed.compression import (
+    available_codecs,
+    compress,
+    decompress,
+    negotiate,
+)
+from autogoal_remote.distributed.remote_algorithm import (
+    dumps_buffers,
+    loads_binary,
+    loads_buffers,
+    pack_frames,
+    unpack_frames,
+)
+from autogoal_remote.production import artifacts
+from autogoal_remote.production.batching import MicroBatcher
+from autogoal_remote.production.cache import PredictionCache
+from autogoal_remote.production.streaming import (
+    DATA_FRAME,
+    FrameReader,
+    LineReader,
+    decode_chunk,
+    encode_chunk,
+    encode_error,
+    encode_record,
+)
 
 
 class Body(BaseModel):
     values: Any
+    # codec `values` is compressed with, if any
+    codec: Optional[str] = None
+    # codecs the prediction may be compressed with, in order of preference
+    accept: Optional[List[str]] = None
 
 
 app = FastAPI()
+metrics.install(app, "production")
+
+# codecs predictions may be compressed with, in order of preference.
+# Defaults to every installed codec.
+compression_codecs = available_codecs()
+
+# predictions smaller than this (in bytes) are never compressed. Defaults to 64Kb.
+compression_threshold = 64 * 1024
+
+# merge concurrent prediction requests into a single `predict` call (see
+# `MicroBatcher`). Defaults to False.
+batching = False
+
+# maximum number of samples predicted at once when batching. Defaults to 64.
+max_batch_size = 64
+
+# seconds a request may wait for others to join its batch. Defaults to 5ms.
+max_batch_wait = 0.005
+
+# batcher shared by every request, created on first use.
+_batcher = None
+
+# number of NDJSON records predicted at once on `/stream`. Defaults to 1000.
+stream_chunk_size = 1000
+
+# keep predictions in memory and answer identical requests from them (see
+# `PredictionCache`). Loading a different model empties the cache.
+# Defaults to False.
+caching = False
+
+# maximum number of cached predictions. Defaults to 10000.
+cache_max_entries = 10000
+
+# maximum total size (in bytes) of cached predictions. Defaults to 256Mb.
+cache_max_bytes = 256 * 1024 * 1024
+
+# seconds a cached prediction stays valid. `None` keeps it until evicted.
+# Defaults to None.
+cache_ttl = None
+
+# cache shared by every request, created on first use.
+_cache = None
+
+# load exports through a memory-mappable artifact cache (see `artifacts`).
+# Defaults to True.
+artifact_cache = True
+
+# file with an input predicted on startup, before reporting ready, so the first
+# requests don't pay for lazy imports and other first-run setup of the pipeline.
+# JSON files hold a list of records, any other file holds a pickled input.
+# `None` skips the warm-up. Defaults to None.
+warmup_data = None
+
+# predictions made over `warmup_data` on startup. Defaults to 3.
+warmup_rounds = 3
+
+# export loaded in the background once the server is up (see `serve`), if any.
+_model_path = None
+
+# model loaded before forking the workers (see `run`), warmed up by each of them
+# in the background once it is up, if any.
+_forked_model = None
+
+# model the `/input`, `/output` and `/inspect` payloads were computed for, and the
+# payloads themselves.
+_payloads = (None, {})
+
+# startup stage the server is in, and seconds taken by each of them.
+_startup = {"stage": "starting", "seconds": {}, "error": None}
+
+
+@app.on_event("startup")
+def startup():
+    if _model_path is not None and getattr(app, "model", None) is None:
+        threading.Thread(
+            target=_load, args=(_model_path,), name="autogoal-remote-load", daemon=True
+        ).start()
+    elif _forked_model is not None and getattr(app, "model", None) is None:
+        threading.Thread(
+            target=_warm,
+            args=(_forked_model,),
+            name="autogoal-remote-warmup",
+            daemon=True,
+        ).start()
+
+
+@app.get("/ready")
+async def ready(request: Request, response: Response):
+    """
+    Tells whether the model is loaded and warmed up, for readiness probes. Answers
+    with status 503 until then.
+    """
+    is_ready = getattr(request.app, "model", None) is not None
+    if not is_ready:
+        response.status_code = 503
+    return {
+        "ready": is_ready,
+        "stage": "ready" if is_ready else _startup["stage"],
+        "seconds": _startup["seconds"],
+        "error": _startup["error"],
+    }
 
 
 @app.get("/input")
@@ -19,12 +162,7 @@ async def input(request: Request):
     """
     Returns the model input type
     """
-    return {
-        "semantic type name": str(request.app.model.best_pipeline_.input_types),
-        "pickled data": dumps(
-            request.app.model.best_pipeline_.input_types, use_dill=True
-        ),
-    }
+    return _describe(_model(request), "/input")
 
 
 @app.get("/output")
@@ -32,15 +170,7 @@ async def output(request: Request):
     """
     Returns the model output type
     """
-    return {
-        "semantic type name": str(
-            request.app.model.best_pipeline_.algorithms[-1].__class__.output_type()
-        ),
-        "pickled data": dumps(
-            request.app.model.best_pipeline_.algorithms[-1].__class__.output_type(),
-            use_dill=True,
-        ),
-    }
+    return _describe(_model(request), "/output")
 
 
 @app.get("/inspect")
@@ -48,7 +178,57 @@ async def inspect(request: Request):
     """
     Returns the model inspect command
     """
-    return {"data": str(inspect_storage(Path(request.app.model.export_path)))}
+    return _describe(_model(request), "/inspect")
+
+
+def _input_payload(model) -> dict:
+    return {
+        "semantic type name": str(model.best_pipeline_.input_types),
+        "pickled data": dumps(model.best_pipeline_.input_types, use_dill=True),
+    }
+
+
+def _output_payload(model) -> dict:
+    output_type = model.best_pipeline_.algorithms[-1].__class__.output_type()
+    return {
+        "semantic type name": str(output_type),
+        "pickled data": dumps(output_type, use_dill=True),
+    }
+
+
+def _inspect_payload(model) -> dict:
+    return {"data": str(inspect_storage(Path(model.export_path)))}
+
+
+_describers = {
+    "/input": _input_payload,
+    "/output": _output_payload,
+    "/inspect": _inspect_payload,
+}
+
+
+def _describe(model, endpoint: str) -> dict:
+    """
+    Returns the payload of `endpoint` for `model`, computed only once per model.
+    """
+    global _payloads
+
+    if _payloads[0] is not model:
+        _payloads = (model, {})
+
+    payloads = _payloads[1]
+    if endpoint not in payloads:
+        payloads[endpoint] = _describers[endpoint](model)
+    return payloads[endpoint]
+
+
+def _model(request: Request):
+    model = getattr(request.app, "model", None)
+    if model is None:
+        raise HTTPException(
+            503, f"Model not ready yet ({_startup['stage']})", {"Retry-After": "1"}
+        )
+    return model
 
 
 @app.post("/")
@@ -56,15 +236,416 @@ async def eval(t: Body, request: Request):
     """
     Returns the model prediction over the provided values
     """
-    model = request.app.model
-    data = loads(t.values)
-    result = model.predict(data)
-    return {"data": dumps(result)}
+    model = _model(request)
+    values = t.values
+    if t.codec is not None:
+        values = decode(decompress(encode(values), t.codec))
+
+    async def compute():
+        with metrics.timer("autogoal_remote_serialization_seconds", op="loads"):
+            data = loads(values)
+        result = await _predict(model, data)
+        with metrics.timer("autogoal_remote_serialization_seconds", op="dumps"):
+            return dumps(result)
+
+    _observe_payload("in", "/", len(values))
+    result = await _cached(model, "eval", encode(values), compute)
+    _observe_payload("out", "/", len(result))
+
+    codec = negotiate(t.accept, compression_codecs)
+    if codec is None or len(result) < compression_threshold:
+        return {"data": result}
+
+    return {"data": decode(compress(encode(result), codec)), "codec": codec}
 
 
-def run(model, ip=None, port=None):
+@app.post("/buffers")
+async def eval_buffers(request: Request):
     """
-    Starts HTTP API with specified model.
+    Returns the model prediction over the provided values. Input and output are
+    pickled with protocol 5 and sent as raw frames (see `pack_frames`), so arrays
+    are rebuilt over the received memory without further copies.
+    """
+    model = _model(request)
+    body = await _read_body(request)
+
+    async def compute():
+        with metrics.timer("autogoal_remote_serialization_seconds", op="loads"):
+            data = loads_buffers(unpack_frames(body))
+        result = await _predict(model, data)
+        with metrics.timer("autogoal_remote_serialization_seconds", op="dumps"):
+            return b"".join(pack_frames(dumps_buffers(result)))
+
+    _observe_payload("in", "/buffers", len(body))
+    content = await _cached(model, "buffers", body, compute)
+    _observe_payload("out", "/buffers", len(content))
+    return Response(content=content, media_type="application/octet-stream")
+
+
+class _DuplexResponse(StreamingResponse):
     """
+    Streaming response produced while the request body is still being read.
+    `StreamingResponse` listens for disconnects by consuming `receive`, which would
+    swallow the body chunks the response is built from.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+@app.post("/stream")
+async def eval_stream(request: Request):
+    """
+    Predicts over a stream of inputs, streaming the predictions back as soon as
+    they are ready. NDJSON bodies (`application/x-ndjson`) hold one record per line
+    and get one prediction per line. Any other body is read as binary frames (see
+    `streaming`), each one a chunk of input that gets a frame with its prediction.
+    """
+    model = _model(request)
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        return _DuplexResponse(
+            _stream_records(model, request), media_type="application/x-ndjson"
+        )
+
+    return _DuplexResponse(
+        _stream_frames(model, request), media_type="application/octet-stream"
+    )
+
+
+async def _stream_frames(model, request: Request):
+    reader = FrameReader()
+    try:
+        async for data in request.stream():
+            for kind, payload in reader.feed(data):
+                if kind != DATA_FRAME:
+                    raise ValueError(f"Unexpected frame of kind {kind}")
+
+                result = await _predict(model, decode_chunk(payload))
+                yield b"".join(encode_chunk(result))
+
+        if reader.pending:
+            raise ValueError("Stream ended in the middle of a frame")
+    except Exception as e:
+        # the response is already on its way, errors travel inside of it
+        yield encode_error(str(e))
+
+
+async def _stream_records(model, request: Request):
+    reader = LineReader()
+    records = []
+    try:
+        async for data in request.stream():
+            for line in reader.feed(data):
+                records.append(json.loads(line))
+                if len(records) >= stream_chunk_size:
+                    yield await _predict_records(model, records)
+                    records = []
+
+        records.extend(json.loads(line) for line in reader.close())
+        if records:
+            yield await _predict_records(model, records)
+    except Exception as e:
+        yield encode_record({"error": str(e)})
+
+
+async def _predict_records(model, records: list) -> bytes:
+    result = await _predict(model, records)
+    return b"".join(encode_record(r) for r in result)
+
+
+async def _cached(model, kind: str, data, compute):
+    global _cache
+
+    if not caching:
+        return await compute()
+
+    if _cache is None:
+        _cache = PredictionCache(cache_max_entries, cache_max_bytes, cache_ttl)
+    return await _cache.get(model, kind, data, compute)
+
+
+async def _predict(model, data):
+    global _batcher
+
+    if not batching:
+        # off the event loop, so other requests (and the cache coalescing them)
+        # keep being served meanwhile
+        return await asyncio.get_event_loop().run_in_executor(
+            None, _timed_predict, model, data
+        )
+
+    if _batcher is None:
+        _batcher = MicroBatcher(
+            partial(_timed_predict, model), max_batch_size, max_batch_wait
+        )
+    return await _batcher.predict(data)
+
+
+def _timed_predict(model, data):
+    with metrics.timer("autogoal_remote_compute_seconds", kind="predict"):
+        return model.predict(data)
+
+
+def _cache_metrics():
+    if _cache is None:
+        return []
+    return [
+        (f"autogoal_remote_cache_{key}", {}, value)
+        for key, value in _cache.stats().items()
+    ]
+
+
+metrics.register_collector(_cache_metrics)
+
+
+def _startup_metrics():
+    return [
+        ("autogoal_remote_startup_seconds", {"stage": stage}, seconds)
+        for stage, seconds in _startup["seconds"].items()
+    ]
+
+
+metrics.register_collector(_startup_metrics)
+
+
+def _observe_payload(direction: str, endpoint: str, size: int):
+    metrics.observe(
+        "autogoal_remote_payload_bytes",
+        size,
+        metrics.size_buckets,
+        direction=direction,
+        endpoint=endpoint,
+    )
+
+
+async def _read_body(request: Request):
+    """
+    Reads the request body into a single writable buffer, preallocated from its
+    `Content-Length` when the client sends one.
+    """
+    length = request.headers.get("content-length")
+    if length is None:
+        return bytearray(await request.body())
+
+    body = bytearray(int(length))
+    offset = 0
+    async for chunk in request.stream():
+        body[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return body
+
+
+def run(model, ip=None, port=None, batch=None, workers=1, cache=None, warmup=None):
+    """
+    Starts HTTP API with specified model. `batch` turns micro-batching on or off,
+    see `batching`, `cache` the prediction cache, see `caching`, and `warmup` is the
+    input predicted before serving, see `warmup_data`. With several `workers`, the
+    API is served by that many forked processes sharing the model memory (see
+    `serve`), each running the warm-up on its own once it is up.
+    """
+    global _forked_model
+
+    _configure(batch, cache, warmup)
+
+    if workers <= 1:
+        prepare(model)
+        app.model = model
+        uvicorn.run(app, host=ip or "0.0.0.0", port=port or 8000)
+        return
+
+    # predicting may start native thread pools (e.g. OpenMP, BLAS), which don't
+    # survive a fork and would hang the workers, so they warm up after it
+    prepare(model, warm=False)
+    if warmup_data is None:
+        app.model = model
+    else:
+        _forked_model = model
+    _run_workers(ip, port, workers)
+
+
+def serve(
+    path,
+    ip=None,
+    port=None,
+    workers=1,
+    prefork=True,
+    batch=None,
+    cache=None,
+    warmup=None,
+):
+    """
+    Loads the AutoML model exported at `path` and serves it with `workers` processes.
+
+    With `prefork` the model is loaded once and the workers are forked afterwards,
+    sharing its memory copy-on-write, and warm it up on their own. Otherwise every worker
+    loads its own copy once it is up, for models that don't survive a fork (e.g.
+    holding threads or GPU contexts), and `/ready` tells when it is done. A single
+    worker also loads the model once it is up.
+    """
+    global _model_path
+
+    if prefork and workers > 1:
+        return run(load_model(path), ip, port, batch, workers, cache, warmup)
+
+    _configure(batch, cache, warmup)
+    _model_path = path
+    if workers <= 1:
+        uvicorn.run(app, host=ip or "0.0.0.0", port=port or 8000)
+    else:
+        _run_workers(ip, port, workers)
+
+
+def _configure(batch=None, cache=None, warmup=None):
+    global batching, caching, warmup_data
+
+    if batch is not None:
+        batching = batch
+    if cache is not None:
+        caching = cache
+    if warmup is not None:
+        warmup_data = warmup
+
+
+def load_model(path):
+    """
+    Loads the AutoML model exported at `path`, through the artifact cache if
+    `artifact_cache` is on.
+    """
+    from autogoal.ml import AutoML
+
+    def folder_load(path):
+        return AutoML.folder_load(Path(path))
+
+    with _stage("load"):
+        if not artifact_cache:
+            return folder_load(path)
+        return artifacts.load(path, folder_load)
+
+
+def prepare(model, warm=True):
+    """
+    Gets `model` ready to serve: computes its `/input`, `/output` and `/inspect`
+    payloads and, with `warm`, runs the warm-up predictions (see `warmup_data`).
+    """
+    with _stage("describe"):
+        for endpoint in _describers:
+            try:
+                _describe(model, endpoint)
+            except Exception:
+                # e.g. models that weren't exported, which fail again on request
+                pass
+
+    if warm:
+        warm_up(model)
+
+
+def warm_up(model):
+    """
+    Runs the warm-up predictions of `model` over `warmup_data`, if any.
+    """
+    if warmup_data is not None:
+        with _stage("warmup"):
+            data = _read_warmup(warmup_data)
+            for _ in range(warmup_rounds):
+                # the same steps as a request, so serialization is warmed up too
+                dumps(model.predict(loads(dumps(data))))
+
+    _startup["stage"] = "ready"
+
+
+def _read_warmup(path):
+    path = Path(path)
+    if path.suffix == ".json":
+        return json.loads(path.read_text())
+    return loads_binary(path.read_bytes())
+
+
+@contextmanager
+def _stage(name: str):
+    _startup["stage"] = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup["seconds"][name] = time.perf_counter() - start
+
+
+def _load(path):
+    try:
+        model = load_model(path)
+        prepare(model)
+    except Exception as e:
+        traceback.print_exc()
+        _startup.update(stage="failed", error=str(e))
+        return
+
+    app.model = model
+
+
+def _warm(model):
+    try:
+        warm_up(model)
+    except Exception as e:
+        traceback.print_exc()
+        _startup.update(stage="failed", error=str(e))
+        return
+
     app.model = model
-    uvicorn.run(app, host=ip or "0.0.0.0", port=port or 8000)
+
+
+def _run_workers(ip, port, workers: int):
+    """
+    Binds the listening socket and forks `workers` processes serving `app` on it.
+    Workers killed by a signal are replaced until the parent is asked to stop.
+    """
+    config = uvicorn.Config(app, host=ip or "0.0.0.0", port=port or 8000)
+    sock = config.bind_socket()
+
+    # objects alive by now (i.e. the model) are left alone by the collector, which
+    # would otherwise write to their pages and undo the sharing between workers.
+    gc.freeze()
+
+    def start():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                uvicorn.Server(config).run(sockets=[sock])
+            except BaseException:
+                code = 1
+                # `os._exit` skips flushing, so the traceback is written out first
+                traceback.print_exc()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+        return pid
+
+    children = {start() for _ in range(workers)}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        # workers killed by a signal (e.g. out of memory) are replaced, the ones
+        # that failed on their own would just fail again
+        children.discard(pid)
+        if not stopping and os.WIFSIGNALED(status):
+            children.add(start())
+
+    sock.close()
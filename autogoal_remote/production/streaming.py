@@ -0,0 +1,123 @@
+"""
+Wire formats for the streaming prediction endpoint (`POST /stream`).
+
+Binary streams are a sequence of frames, each one a `STREAM_FRAME` header with its
+kind and payload length followed by the payload. Data payloads hold a chunk of
+input (or its prediction) as built by `pack_frames(dumps_buffers(chunk))`, error
+payloads an utf-8 message. NDJSON streams hold one JSON record per line.
+"""
+
+import json
+import struct
+from typing import Iterator, List, Tuple
+
+from autogoal_remote.distributed.remote_algorithm import (
+    dumps_buffers,
+    loads_buffers,
+    pack_frames,
+    unpack_frames,
+)
+
+STREAM_FRAME = struct.Struct("!BQ")
+DATA_FRAME = 0
+ERROR_FRAME = 1
+
+
+def encode_chunk(data) -> List[memoryview]:
+    frames = pack_frames(dumps_buffers(data))
+    size = sum(memoryview(f).nbytes for f in frames)
+    return [STREAM_FRAME.pack(DATA_FRAME, size)] + frames
+
+
+def encode_error(message: str) -> bytes:
+    payload = message.encode()
+    return STREAM_FRAME.pack(ERROR_FRAME, len(payload)) + payload
+
+
+def decode_chunk(payload):
+    return loads_buffers(unpack_frames(payload))
+
+
+class FrameReader:
+    """
+    Splits a byte stream, received in arbitrary pieces, into `(kind, payload)`
+    frames. Each payload gets its own writable buffer.
+    """
+
+    def __init__(self):
+        self._header = bytearray()
+        self._kind = None
+        self._payload = None
+        self._offset = 0
+
+    def feed(self, data) -> Iterator[Tuple[int, bytearray]]:
+        data = memoryview(data).cast("B")
+        while data.nbytes:
+            if self._payload is None:
+                missing = STREAM_FRAME.size - len(self._header)
+                self._header += data[:missing]
+                data = data[missing:]
+                if len(self._header) < STREAM_FRAME.size:
+                    return
+
+                self._kind, size = STREAM_FRAME.unpack(self._header)
+                self._header = bytearray()
+                self._payload = bytearray(size)
+                self._offset = 0
+
+            missing = len(self._payload) - self._offset
+            piece = data[:missing]
+            self._payload[self._offset : self._offset + piece.nbytes] = piece
+            self._offset += piece.nbytes
+            data = data[piece.nbytes :]
+
+            if self._offset == len(self._payload):
+                frame = (self._kind, self._payload)
+                self._payload = None
+                yield frame
+
+    @property
+    def pending(self) -> bool:
+        """
+        Whether the stream stopped in the middle of a frame.
+        """
+        return self._payload is not None or bool(self._header)
+
+
+class LineReader:
+    """
+    Splits a byte stream, received in arbitrary pieces, into lines.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data) -> Iterator[bytes]:
+        self._buffer += data
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(self._buffer[start:end]).strip()
+            if line:
+                yield line
+            start = end + 1
+        del self._buffer[:start]
+
+    def close(self) -> Iterator[bytes]:
+        line = bytes(self._buffer).strip()
+        self._buffer = bytearray()
+        if line:
+            yield line
+
+
+def _jsonable(value):
+    # NumPy values, the most common predictions, know how to become plain Python
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_record(record) -> bytes:
+    return json.dumps(record, default=_jsonable).encode() + b"\n"
@@ -0,0 +1,326 @@
+"""
+Tracing of remote calls, with a breakdown of where their time goes.
+
+Sampled calls carry a trace context (`trace_id` and `span_id`) in their request.
+The server times every phase it goes through (waiting for admission, loading the
+arguments, the call itself, dumping the result...) and sends the timings back
+along with the response. The client turns both sides into spans, written to
+`trace_file` either as JSON lines or in the OpenTelemetry (OTLP/JSON) format.
+Spans are written by a background thread, so ending one never blocks the caller
+(e.g. an event loop) on the file. Call `flush` to wait until they are written.
+"""
+
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# fraction of remote calls that are traced, between 0 and 1. Defaults to 0.
+sample_rate = 0.0
+
+# file spans are appended to. Defaults to "autogoal-remote-traces.jsonl".
+trace_file = "autogoal-remote-traces.jsonl"
+
+# format of `trace_file`. "jsonl" writes one span per line, "otlp" one OTLP/JSON
+# `ExportTraceServiceRequest` per trace, as the OpenTelemetry file exporter does.
+# Defaults to "jsonl".
+trace_format = "jsonl"
+
+# order in which the server goes through the phases it reports.
+server_phases = ("queue", "execute", "loads", "call", "dumps")
+
+# spans ended but not written yet, and the process the writer thread runs in.
+_queue = queue.Queue()
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+class Span:
+    """
+    A traced remote call. Phases measured on this side are added with `phase`, the
+    ones measured by the server with `add_server_timings`. Call `end` when done.
+    """
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = _new_id(16)
+        self.span_id = _new_id(8)
+        self.start = time.time_ns()
+        self.end_time = None
+        self.error = None
+        self.children = []
+
+    @property
+    def context(self) -> dict:
+        return {"trace_id": self.trace_id, "span_id": self.span_id}
+
+    def add(self, name: str, start: int, end: int, kind="client", **attributes):
+        self.children.append(
+            {
+                "name": name,
+                "span_id": _new_id(8),
+                "start": start,
+                "end": end,
+                "kind": kind,
+                "attributes": attributes,
+            }
+        )
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.time_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time_ns())
+
+    def add_server_timings(self, timings: Dict[str, float], start: int, end: int):
+        """
+        Adds the phases measured by the server while this side waited from `start`
+        to `end`. The server only reports durations, so its phases are laid out one
+        after the other, centered in the wait (i.e. network time split evenly).
+        """
+        server = int(timings.get("server", 0) * 1e9)
+        offset = start + max(end - start - server, 0) // 2
+        self.add("server", offset, offset + server, kind="server")
+
+        # `execute` covers loads, call and dumps (plus the trip to a worker)
+        cursor = offset
+        for name in server_phases:
+            if name not in timings:
+                continue
+
+            duration = int(timings[name] * 1e9)
+            self.add(f"server.{name}", cursor, cursor + duration, kind="server")
+            if name == "execute":
+                # the trip to the worker process, if any, is what's left of it
+                inner = sum(timings.get(p, 0) for p in ("loads", "call", "dumps"))
+                cursor += max(duration - int(inner * 1e9), 0) // 2
+            else:
+                cursor += duration
+
+    def end(self, error: Exception = None):
+        self.end_time = time.time_ns()
+        self.error = None if error is None else str(error)
+        export(self)
+
+
+def start(name: str, **attributes) -> Optional[Span]:
+    """
+    Returns a new span for a remote call, or `None` if the call is not sampled.
+    """
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return None
+    return Span(name, **attributes)
+
+
+@contextmanager
+def phase(span: Optional[Span], name: str):
+    """
+    Times the block as a phase of `span`, if any.
+    """
+    if span is None:
+        yield
+    else:
+        with span.phase(name):
+            yield
+
+
+@contextmanager
+def timed(timings: Optional[dict], name: str):
+    """
+    Adds the seconds spent inside the block to `timings[name]`, if `timings` is given.
+    Used by the server to report the phases of traced requests.
+    """
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """
+    Yields a span for the remote call made inside the block, or `None` if it is not
+    sampled. The span ends with the block, recording the error that ended it, if any.
+    """
+    span = start(name, **attributes)
+    if span is None:
+        yield None
+        return
+
+    try:
+        yield span
+    except Exception as e:
+        span.end(e)
+        raise
+    else:
+        span.end()
+
+
+def _records(span: Span) -> list:
+    records = [
+        {
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": None,
+            "name": span.name,
+            "kind": "client",
+            "start": span.start,
+            "end": span.end_time,
+            "duration": (span.end_time - span.start) / 1e9,
+            "attributes": span.attributes,
+            "error": span.error,
+        }
+    ]
+    for child in span.children:
+        records.append(
+            {
+                "trace_id": span.trace_id,
+                "span_id": child["span_id"],
+                "parent_id": span.span_id,
+                "name": child["name"],
+                "kind": child["kind"],
+                "start": child["start"],
+                "end": child["end"],
+                "duration": (child["end"] - child["start"]) / 1e9,
+                "attributes": child["attributes"],
+                "error": None,
+            }
+        )
+    return records
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp(span: Span) -> dict:
+    kinds = {"client": 3, "server": 2}
+    spans = []
+    for record in _records(span):
+        otlp_span = {
+            "traceId": record["trace_id"],
+            "spanId": record["span_id"],
+            "name": record["name"],
+            "kind": kinds.get(record["kind"], 1),
+            "startTimeUnixNano": str(record["start"]),
+            "endTimeUnixNano": str(record["end"]),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in record["attributes"].items()
+            ],
+            "status": {"code": 2, "message": record["error"]}
+            if record["error"] is not None
+            else {"code": 1},
+        }
+        if record["parent_id"] is not None:
+            otlp_span["parentSpanId"] = record["parent_id"]
+        spans.append(otlp_span)
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": "autogoal"}}
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": "autogoal_remote"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+def export(span: Span):
+    """
+    Queues `span` to be written to `trace_file` by the writer thread.
+    """
+    _start_writer()
+    _queue.put(span)
+
+
+def flush():
+    """
+    Waits until every span ended so far is written to `trace_file`.
+    """
+    if _writer_pid == os.getpid():
+        _queue.join()
+
+
+def _start_writer():
+    # started on first use, and again in forked processes, where it doesn't survive
+    global _writer_pid
+
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+
+        _writer_pid = os.getpid()
+        threading.Thread(
+            target=_write_periodically, name="autogoal-remote-traces", daemon=True
+        ).start()
+
+
+def _write_periodically():
+    while True:
+        spans = [_queue.get()]
+        # whatever piled up meanwhile is written at once
+        while True:
+            try:
+                spans.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            _write(spans)
+        except Exception as e:
+            warnings.warn(f"Spans not written to {trace_file}: {e}")
+        finally:
+            for _ in spans:
+                _queue.task_done()
+
+
+def _write(spans: list):
+    lines = []
+    for span in spans:
+        if trace_format == "otlp":
+            lines.append(json.dumps(_otlp(span)))
+        else:
+            lines.extend(json.dumps(record) for record in _records(span))
+
+    with open(trace_file, "a") as fd:
+        fd.write("\n".join(lines) + "\n")
+
+
+def _reset_after_fork():
+    # spans queued by the parent are its own to write
+    global _queue, _writer_lock
+    _queue = queue.Queue()
+    _writer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush)
@@ -0,0 +1,36 @@
+"""
+Stand-in algorithms served by the benchmarks, so no contrib needs to be installed.
+"""
+
+import time
+
+from autogoal.kb import AlgorithmBase, MatrixContinuousDense
+
+
+class Echo(AlgorithmBase):
+    """
+    Returns its input untouched, so a call costs only the transport.
+    """
+
+    # class-level value, answered from the attribute manifest
+    label = "echo"
+
+    def __init__(self):
+        self.calls = 0
+
+    def run(self, X: MatrixContinuousDense) -> MatrixContinuousDense:
+        self.calls += 1
+        return X
+
+
+class Sleep(AlgorithmBase):
+    """
+    Waits `delay` seconds before returning its input, like a compute-bound call.
+    """
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+
+    def run(self, X: MatrixContinuousDense) -> MatrixContinuousDense:
+        time.sleep(self.delay)
+        return X
@@ -0,0 +1,427 @@
+"""
+Loopback benchmarks for the distributed proxy call path.
+
+Starts `autogoal_remote.distributed.server` on localhost, exposing the stand-ins in
+`benchmarks.algorithms`, and measures through `RemoteAlgorithmBase` proxies:
+
+- `instantiate`: creating (and releasing) a remote instance.
+- `attribute`: reading an attribute answered by the manifest, and one read remotely.
+- `run`: calling `run` with arrays of several sizes.
+- `concurrency`: calls per second with several threads calling at once.
+- `chunk_size`: the legacy `/algorithm/call` endpoint, with several chunk sizes
+  for `send_large_message`.
+- `frame_size`: the `/session` endpoint, with several frame sizes.
+
+Both size benchmarks start a server of their own for every size, so requests and
+responses are split the same way.
+
+Every measurement becomes one JSON record, written along with the commit, Python
+and platform they were taken on, so runs can be compared across versions:
+
+    python -m benchmarks.proxy --output results.json
+    python -m benchmarks.proxy --quick --only run --only concurrency
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BENCHMARKS = [
+    "instantiate",
+    "attribute",
+    "run",
+    "concurrency",
+    "chunk_size",
+    "frame_size",
+]
+
+# payload sizes (in bytes) of the arrays sent to `run`.
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+QUICK_PAYLOAD_SIZES = [1024, 1024 * 1024]
+
+# number of threads calling at once, and the payload they send.
+CONCURRENCY = [1, 4, 16]
+QUICK_CONCURRENCY = [1, 4]
+CONCURRENCY_PAYLOAD = 64 * 1024
+
+# chunk sizes of the legacy endpoint, and the payload they split. Clients accept
+# messages of up to 1Mb, which JSON escaping can make chunks above 128Kb exceed.
+CHUNK_SIZES = [500, 16 * 1024, 128 * 1024]
+CHUNK_PAYLOAD = 256 * 1024
+
+# frame sizes of the session endpoint, and the payload they split.
+FRAME_SIZES = [64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+FRAME_PAYLOAD = 16 * 1024 * 1024
+QUICK_FRAME_PAYLOAD = 1024 * 1024
+
+
+def serve(port: int, mode: str, chunk_size: int = None, frame_size: int = None):
+    """
+    Runs the benchmark server in this process, until it is terminated.
+    """
+    from autogoal_remote.distributed import server
+    from benchmarks import algorithms
+
+    server.stored_data = [algorithms.Echo, algorithms.Sleep]
+    server.execution_mode = mode
+    if chunk_size is not None:
+        server.call_chunk_size = chunk_size
+    if frame_size is not None:
+        # same-host sessions would move large payloads to shared memory instead
+        server.session_frame_size = frame_size
+        server.local_transport = False
+    server.run("127.0.0.1", port)
+
+
+def start_server(
+    port: int,
+    mode: str,
+    verbose=False,
+    timeout=60,
+    chunk_size: int = None,
+    frame_size: int = None,
+):
+    output = None if verbose else subprocess.DEVNULL
+    sizes = []
+    if chunk_size is not None:
+        sizes += ["--chunk-size", str(chunk_size)]
+    if frame_size is not None:
+        sizes += ["--frame-size", str(frame_size)]
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.proxy", "--serve"]
+        + ["--port", str(port), "--mode", mode]
+        + sizes,
+        cwd=ROOT,
+        stdout=output,
+        stderr=output,
+    )
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(
+                f"Benchmark server exited with code {process.returncode}, run with --verbose to see why"
+            )
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise Exception(f"Benchmark server not listening on port {port} after {timeout}s")
+
+
+@contextmanager
+def sized_server(args, **sizes):
+    """
+    Runs a benchmark server of its own with the given `chunk_size` or `frame_size`,
+    and yields its port and an `Echo` instance on it.
+    """
+    from autogoal_remote.distributed import client, get_algorithms
+
+    port = free_port()
+    process = start_server(port, args.mode, args.verbose, **sizes)
+    try:
+        algorithms = {cls.dto.name: cls for cls in get_algorithms("127.0.0.1", port)}
+        instance = algorithms["Echo"]()
+        yield port, instance
+        client.run_sync(instance.adelete())
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def payload(size: int):
+    return np.random.rand(max(size // 8, 1))
+
+
+def measure(func, repeat: int, warmup: int = 2) -> list:
+    """
+    Returns the duration, in seconds, of `repeat` calls to `func`.
+    """
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def record(benchmark: str, params: dict, durations: list, nbytes=0, elapsed=None):
+    """
+    Summarizes `durations` of single calls. Throughput is computed over `elapsed`
+    seconds when given (i.e. calls made concurrently), over their sum otherwise.
+    """
+    durations = sorted(durations)
+    n = len(durations)
+    elapsed = sum(durations) if elapsed is None else elapsed
+
+    result = {
+        "benchmark": benchmark,
+        "params": params,
+        "n": n,
+        "mean": sum(durations) / n,
+        "p50": durations[n // 2],
+        "p95": durations[min(n - 1, int(n * 0.95))],
+        "min": durations[0],
+        "max": durations[-1],
+        "ops_per_sec": n / elapsed,
+    }
+    if nbytes:
+        result["bytes_per_sec"] = nbytes * n / elapsed
+
+    print(
+        f"{benchmark:<12} {json.dumps(params):<40} "
+        f"p50={result['p50'] * 1000:9.3f}ms ops/s={result['ops_per_sec']:10.1f}",
+        file=sys.stderr,
+    )
+    return result
+
+
+def bench_instantiate(algorithms, args):
+    Echo = algorithms["Echo"]
+    # the proxy is released right away, which also sends its `delete`
+    return [record("instantiate", {}, measure(lambda: Echo(), args.repeat))]
+
+
+def bench_attribute(algorithms, args):
+    instance = algorithms["Echo"]()
+    return [
+        record(
+            "attribute",
+            {"source": "manifest"},
+            measure(lambda: instance.label, args.repeat),
+        ),
+        record(
+            "attribute",
+            {"source": "remote"},
+            measure(lambda: instance.calls, args.repeat),
+        ),
+    ]
+
+
+def bench_run(algorithms, args):
+    instance = algorithms["Echo"]()
+    results = []
+    for size in QUICK_PAYLOAD_SIZES if args.quick else PAYLOAD_SIZES:
+        X = payload(size)
+        # the largest payloads take long enough to be measured fewer times
+        repeat = args.repeat if size <= 1024 * 1024 else max(args.repeat // 10, 3)
+        results.append(
+            record(
+                "run",
+                {"payload": X.nbytes},
+                measure(lambda: instance.run(X), repeat),
+                nbytes=2 * X.nbytes,
+            )
+        )
+    return results
+
+
+def bench_concurrency(algorithms, args):
+    X = payload(CONCURRENCY_PAYLOAD)
+    results = []
+    for name in ["Echo", "Sleep"]:
+        for threads in QUICK_CONCURRENCY if args.quick else CONCURRENCY:
+            # one instance per thread, calls on the same instance are serialized
+            instances = [algorithms[name]() for _ in range(threads)]
+            for instance in instances:
+                instance.run(X)
+
+            def calls(instance):
+                return measure(lambda: instance.run(X), args.repeat, warmup=0)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(threads) as executor:
+                durations = sum(executor.map(calls, instances), [])
+            elapsed = time.perf_counter() - start
+
+            results.append(
+                record(
+                    "concurrency",
+                    {"algorithm": name, "threads": threads, "payload": X.nbytes},
+                    durations,
+                    nbytes=2 * X.nbytes,
+                    elapsed=elapsed,
+                )
+            )
+    return results
+
+
+def bench_chunk_size(algorithms, args):
+    from autogoal_remote.distributed import client
+    from autogoal_remote.distributed.remote_algorithm import dumps
+
+    X = payload(CHUNK_PAYLOAD)
+    call_args, call_kwargs = dumps((X,)), dumps({})
+
+    results = []
+    for chunk_size in CHUNK_SIZES:
+        with sized_server(args, chunk_size=chunk_size) as (port, instance):
+            uri = f"{client.build_route('127.0.0.1', port)}/algorithm/call"
+
+            def call():
+                asyncio.run(
+                    client.call_algorithm(
+                        uri, str(instance.id), "run", call_args, call_kwargs, chunk_size
+                    )
+                )
+
+            results.append(
+                record(
+                    "chunk_size",
+                    {"chunk_size": chunk_size, "payload": X.nbytes},
+                    measure(call, args.repeat),
+                    nbytes=2 * X.nbytes,
+                )
+            )
+    return results
+
+
+def bench_frame_size(algorithms, args):
+    from autogoal_remote.distributed import client
+    from autogoal_remote.distributed.remote_algorithm import (
+        dumps_buffers,
+        loads_buffers,
+    )
+    from autogoal_remote.distributed.utils import BufferList
+
+    X = payload(QUICK_FRAME_PAYLOAD if args.quick else FRAME_PAYLOAD)
+    repeat = max(args.repeat // 10, 3)
+
+    async def open_session(port, frame_size):
+        # sessions belong to the client loop, so they are created on it
+        return client.RemoteSession("127.0.0.1", port, frame_size=frame_size)
+
+    results = []
+    for frame_size in FRAME_SIZES:
+        with sized_server(args, frame_size=frame_size) as (port, instance):
+            session = client.run_sync(open_session(port, frame_size))
+
+            def call():
+                response = client.run_sync(
+                    session.request(
+                        "call",
+                        instance_id=str(instance.id),
+                        attr="run",
+                        args=BufferList(dumps_buffers((X,))),
+                        kwargs=BufferList(dumps_buffers({})),
+                    )
+                )
+                loads_buffers(response["result"])
+
+            try:
+                results.append(
+                    record(
+                        "frame_size",
+                        {"frame_size": frame_size, "payload": X.nbytes},
+                        measure(call, repeat),
+                        nbytes=2 * X.nbytes,
+                    )
+                )
+            finally:
+                client.run_sync(session.close())
+    return results
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "mode": args.mode,
+        "repeat": args.repeat,
+        "quick": args.quick,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--output", help="file to write the results to, printed if missing"
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=BENCHMARKS,
+        help="benchmark to run, may be repeated. Defaults to all of them",
+    )
+    parser.add_argument("--mode", choices=["process", "thread"], default="process")
+    parser.add_argument("--port", type=int, help="defaults to any free port")
+    parser.add_argument("--repeat", type=int, help="calls measured per benchmark")
+    parser.add_argument(
+        "--quick", action="store_true", help="fewer sizes and calls, for smoke runs"
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the server output")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--chunk-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--frame-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.port, args.mode, args.chunk_size, args.frame_size)
+
+    args.port = args.port or free_port()
+    args.repeat = args.repeat or (10 if args.quick else 100)
+
+    from autogoal_remote.distributed import get_algorithms
+
+    server = start_server(args.port, args.mode, args.verbose)
+    try:
+        algorithms = {
+            cls.dto.name: cls for cls in get_algorithms("127.0.0.1", args.port)
+        }
+        results = []
+        for name in args.only or BENCHMARKS:
+            results.extend(globals()[f"bench_{name}"](algorithms, args))
+    finally:
+        server.terminate()
+        server.wait()
+
+    output = json.dumps({"meta": metadata(args), "results": results}, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        Path(args.output).write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()